@@ -0,0 +1,360 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from .state import intern_id, save_json
+
+# The event log object types that change who can take calls.
+GROUP = 'group'
+MEMBERSHIP = 'membership'
+CALL = 'activity.call'
+
+# The types whose events are read and applied. Call events are only checked
+# for, since all that matters is whether there have been any.
+_APPLIED_TYPES = (GROUP, MEMBERSHIP)
+
+_ADDED_MEMBERSHIP_ACTIONS = {'created', 'activated'}
+_REMOVED_MEMBERSHIP_ACTIONS = {'deleted', 'deactivated'}
+
+
+def _parse_date(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _member_user_ids(members):
+    """User IDs from a group's members field, as dicts or plain IDs."""
+    return frozenset(
+        intern_id(i['user_id'] if isinstance(i, dict) else i) for i in members
+    )
+
+
+def _object_key(event):
+    """The group ID or user_id an event changes."""
+    if event['object_type'] == MEMBERSHIP:
+        data = event.get('data') or {}
+        return intern_id(data.get('user_id') or event.get('user_id'))
+    return event.get('object_id')
+
+
+class Changes:
+    """
+    What a poll of the event log changed.
+
+    Attributes:
+        members_added (dict): user_id to full name of new active memberships.
+        members_removed (set): user_ids of removed or deactivated memberships.
+        groups_changed (set): Configured group IDs whose members changed.
+        calls (bool): Whether there have been call events. Calls change who
+            is on_call, so availability should be read again.
+    """
+
+    def __init__(self):
+        self.members_added = {}
+        self.members_removed = set()
+        self.groups_changed = set()
+        self.calls = False
+
+    def __bool__(self):
+        return bool(
+            self.members_added
+            or self.members_removed
+            or self.groups_changed
+            or self.calls
+        )
+
+
+class ChangeFeed:
+    """
+    Tails the Close event log from a cursor and keeps the members of the
+    configured groups and the organization's memberships up to date from it.
+
+    The cursors and the state derived from the events are saved together to a
+    local JSON file after every poll, so a restart resumes from where it left
+    off instead of downloading the groups and memberships again. Each process
+    tails the log on its own; they may all share the file, since every write
+    is a consistent cursor and state pair.
+
+    Each object type is read with its own query, so each has its own cursor:
+    the date_updated of the newest event of that type applied. Events can
+    show up in the log after newer ones, so every read goes back
+    `late_window` seconds before the cursor and skips the events it has
+    already applied. A late event older than one already applied to the same
+    group or membership, or than the snapshot, is skipped too, so it can't
+    put back state that has since changed.
+    """
+
+    def __init__(
+        self,
+        api,
+        org_id,
+        group_ids,
+        path,
+        poll_interval=5,
+        page_size=100,
+        late_window=60,
+    ):
+        self.api = api
+        self.org_id = org_id
+        self.group_ids = frozenset(intern_id(i) for i in group_ids)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self.late_window = late_window
+        self._lock = threading.Lock()
+        self._polled_at = None
+        # object type -> date_updated of the newest event applied
+        self.cursors = {}
+        # object type -> {event ID: date_updated} of the events applied
+        # within `late_window` of the cursor
+        self.applied_event_ids = {}
+        # object type -> {group ID or user_id: date_updated} of the newest
+        # event applied to each object within `late_window` of the cursor
+        self.newest_applied = {}
+        # The cursor the groups and memberships were downloaded from. They
+        # already include every event before it.
+        self.snapshot_date = None
+        self.group_users = {}
+        self.memberships = {}
+
+    @property
+    def started(self):
+        """Whether the feed has state to work from."""
+        return bool(self.cursors)
+
+    def start(self):
+        """Resume from the saved state, or snapshot Close if there is none."""
+        if self._load():
+            logging.info(f'Resuming the Close change feed from {self.cursors}')
+            return
+        # Take the cursor before the snapshot, so that anything that changes
+        # while we're downloading is replayed by the first poll. It's only
+        # set once the snapshot is complete, since a cursor means the feed
+        # has state to work from.
+        cursor = self._newest_event_date()
+        self.group_users = {
+            group: _member_user_ids(
+                self.api.get(f'group/{group}', params={'_fields': 'members'})[
+                    'members'
+                ]
+            )
+            for group in self.group_ids
+        }
+        self.memberships = {
+            intern_id(i['user_id']): i.get('user_full_name')
+            for i in self.api.get(
+                'organization/' + self.org_id,
+                params={'_fields': 'memberships'},
+            )['memberships']
+        }
+        self.applied_event_ids = {i: {} for i in _APPLIED_TYPES}
+        self.newest_applied = {i: {} for i in _APPLIED_TYPES}
+        self.snapshot_date = cursor
+        self.cursors = {i: cursor for i in _APPLIED_TYPES + (CALL,)}
+        self._save()
+        logging.info(f'Started the Close change feed from {cursor}')
+
+    def poll(self, force=False):
+        """
+        Apply any new events, at most once every `poll_interval` seconds unless
+        forced. If another thread is already polling this returns straight
+        away and the caller works from the state as it is.
+
+        Returns:
+            Changes: What changed, or None if the log wasn't read.
+        """
+        if not force and self._polled_at is not None:
+            if time.monotonic() - self._polled_at < self.poll_interval:
+                return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            events = []
+            for object_type in _APPLIED_TYPES:
+                # The log is newest first; apply oldest first, keeping the
+                # log's order between events that share a timestamp.
+                events.extend(
+                    reversed(list(self._iter_new_events(object_type)))
+                )
+            changes = Changes()
+            changes.calls = self._has_new_calls()
+            events.sort(key=lambda i: _parse_date(i['date_updated']))
+            for event in events:
+                if not self._is_stale(event):
+                    self._apply(event, changes)
+                self._applied(event)
+            self._forget_old_events()
+            if events or changes.calls:
+                self._save()
+            self._polled_at = time.monotonic()
+            return changes
+        finally:
+            self._lock.release()
+
+    def _window_start(self, object_type):
+        """The date a read of a type goes back to."""
+        start = _parse_date(self.cursors[object_type]) - timedelta(
+            seconds=self.late_window
+        )
+        return start.isoformat()
+
+    def _iter_new_events(self, object_type):
+        """Stream the events of a type from its window not yet applied."""
+        applied = self.applied_event_ids.setdefault(object_type, {})
+        params = {
+            'object_type': object_type,
+            'date_updated__gte': self._window_start(object_type),
+            '_limit': self.page_size,
+        }
+        while True:
+            resp = self.api.get('event', params=params)
+            for event in resp['data']:
+                if event['id'] not in applied:
+                    yield event
+            if not resp.get('cursor_next') or not resp['data']:
+                return
+            params = dict(params, _cursor=resp['cursor_next'])
+
+    def _is_stale(self, event):
+        """
+        Whether the event is older than the snapshot or than an event already
+        applied to the same object.
+        """
+        date_updated = _parse_date(event['date_updated'])
+        if self.snapshot_date and date_updated < _parse_date(
+            self.snapshot_date
+        ):
+            return True
+        newest = self.newest_applied.get(event['object_type'], {}).get(
+            _object_key(event)
+        )
+        return newest is not None and date_updated < _parse_date(newest)
+
+    def _applied(self, event):
+        """Move the cursor of the event's type on past it."""
+        object_type = event['object_type']
+        applied = self.applied_event_ids.setdefault(object_type, {})
+        applied[event['id']] = event['date_updated']
+        key = _object_key(event)
+        newest = self.newest_applied.setdefault(object_type, {})
+        if key and (
+            key not in newest
+            or _parse_date(event['date_updated']) > _parse_date(newest[key])
+        ):
+            newest[key] = event['date_updated']
+        if _parse_date(event['date_updated']) > _parse_date(
+            self.cursors[object_type]
+        ):
+            self.cursors[object_type] = event['date_updated']
+
+    def _forget_old_events(self):
+        """Forget applied events older than the window, which isn't re-read."""
+        for by_type in (self.applied_event_ids, self.newest_applied):
+            for object_type, applied in by_type.items():
+                window_start = _parse_date(self._window_start(object_type))
+                for key, date_updated in list(applied.items()):
+                    if _parse_date(date_updated) < window_start:
+                        del applied[key]
+
+    def _has_new_calls(self):
+        """
+        Whether there are call events after the cursor, moving the cursor to
+        the newest. Only one event is read, however many there are.
+        """
+        resp = self.api.get(
+            'event',
+            params={
+                'object_type': CALL,
+                'date_updated__gt': self.cursors[CALL],
+                '_limit': 1,
+            },
+        )
+        if not resp['data']:
+            return False
+        self.cursors[CALL] = resp['data'][0]['date_updated']
+        return True
+
+    def _apply(self, event, changes):
+        data = event.get('data') or {}
+        object_type = event['object_type']
+        action = event['action']
+        if object_type == GROUP:
+            group = event['object_id']
+            if group not in self.group_ids:
+                return
+            if action == 'deleted':
+                self.group_users[group] = frozenset()
+            elif 'members' in data:
+                self.group_users[group] = _member_user_ids(data['members'])
+            else:
+                return
+            changes.groups_changed.add(group)
+        elif object_type == MEMBERSHIP:
+            user_id = _object_key(event)
+            if not user_id:
+                return
+            if action in _ADDED_MEMBERSHIP_ACTIONS:
+                name = data.get('user_full_name')
+                self.memberships[user_id] = name
+                changes.members_removed.discard(user_id)
+                changes.members_added[user_id] = name
+            elif action in _REMOVED_MEMBERSHIP_ACTIONS:
+                self.memberships.pop(user_id, None)
+                changes.members_added.pop(user_id, None)
+                changes.members_removed.add(user_id)
+
+    def _newest_event_date(self):
+        resp = self.api.get('event', params={'_limit': 1})
+        if resp['data']:
+            return resp['data'][0]['date_updated']
+        return datetime.now(timezone.utc).isoformat()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.error(
+                f'Ignoring the saved Close change feed in {self.path} because {str(e)}'
+            )
+            return False
+        if (
+            saved.get('org_id') != self.org_id
+            or set(saved.get('group_users', {})) != set(self.group_ids)
+            or 'cursors' not in saved
+        ):
+            # Saved for another org, another set of queues or by an older
+            # version of the feed.
+            return False
+        self.cursors = saved['cursors']
+        self.applied_event_ids = saved['applied_event_ids']
+        self.newest_applied = saved.get('newest_applied', {})
+        self.snapshot_date = saved.get('snapshot_date')
+        self.group_users = {
+            intern_id(k): frozenset(intern_id(i) for i in v)
+            for k, v in saved['group_users'].items()
+        }
+        self.memberships = {
+            intern_id(k): v for k, v in saved['memberships'].items()
+        }
+        return True
+
+    def _save(self):
+        saved = {
+            'org_id': self.org_id,
+            'cursors': self.cursors,
+            'applied_event_ids': self.applied_event_ids,
+            'newest_applied': self.newest_applied,
+            'snapshot_date': self.snapshot_date,
+            'group_users': {k: sorted(v) for k, v in self.group_users.items()},
+            'memberships': self.memberships,
+        }
+        try:
+            save_json(self.path, saved)
+        except Exception as e:
+            logging.error(
+                f'Failed to save the Close change feed to {self.path} because {str(e)}'
+            )
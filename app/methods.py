@@ -1,40 +1,70 @@
 import json
 import logging
 import os
+import time
 
 import flask
-from closeio_api import Client as CloseIO_API
 from flask import Response, url_for
-from twilio.rest import Client
 from twilio.twiml.voice_response import VoiceResponse
 
+from . import shards
+from .change_feed import ChangeFeed
+from .profiling import profiled
+from .resilience import Deadline, DeadlineExceeded, run_with_deadline, submit
+from .state import Activity, WorkerState, intern_groups, intern_id
+from .tenants import TenantLogFilter, current_tenant, tenants
+
 # Format Logging
-log_format = "[%(asctime)s] %(levelname)s %(message)s"
+log_format = "[%(asctime)s] %(levelname)s [%(tenant)s] %(message)s"
 logging.basicConfig(level=logging.INFO, format=log_format)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TenantLogFilter())
 twilio_logger = logging.getLogger('twilio')
 twilio_logger.setLevel(logging.ERROR)
 
-SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
-json_url = os.path.join(SITE_ROOT, "static/", "config.json")
-with open(json_url) as f:
-    config = json.load(f)
+# Everything below works on behalf of the current tenant (see tenants.py),
+# which holds the Close and Twilio clients, config and caches for one Close
+# organization and TaskRouter workspace.
 
-# Initialize Close Variables
-api = CloseIO_API(os.environ.get('CLOSE_API_KEY'))
-org_id = api.get('api_key/' + os.environ.get('CLOSE_API_KEY'))[
-    'organization_id'
-]
+# Caller-facing routes answer within CALL_PATH_BUDGET_SECONDS. Upstream work
+# gives up CALL_PATH_RESPONSE_MARGIN_SECONDS before that, leaving time to fall
+# back and build the response.
+call_path_budget_seconds = float(
+    os.environ.get('CALL_PATH_BUDGET_SECONDS', 5)
+)
+call_path_response_margin_seconds = float(
+    os.environ.get('CALL_PATH_RESPONSE_MARGIN_SECONDS', 0.5)
+)
 
-# Initialize the Twilio API
-twilio_client = Client(
-    os.environ.get('TWILIO_ACCOUNT_SID'), os.environ.get('TWILIO_AUTH_TOKEN')
+# How old the last known good view of which groups have agents available can
+# be before a caller-facing route re-checks TaskRouter.
+routing_state_max_age_seconds = float(
+    os.environ.get('ROUTING_STATE_MAX_AGE_SECONDS', 5)
 )
-workspace_sid = os.environ.get('TWILIO_WORKSPACE_SID')
-workflow_sid = os.environ.get('TWILIO_WORKFLOW_SID')
 
 # The Base URL of the Application
 base_url = os.environ.get('BASE_URL')
 
+# How many records to pull per request when paging through Twilio Workers and
+# Close availability. Records are consumed a page at a time, so this bounds how
+# many of them a sync holds in memory at once.
+twilio_page_size = int(os.environ.get('TWILIO_PAGE_SIZE', 100))
+close_page_size = int(os.environ.get('CLOSE_PAGE_SIZE', 100))
+
+# When a tenant's CHANGE_FEED_STATE_PATH is set, group members and memberships
+# are kept up to date by tailing the Close event log instead of being
+# downloaded on every sync, and Close availability is reused between syncs for
+# up to CLOSE_AVAILABILITY_MAX_AGE_SECONDS unless a call happens in the
+# meantime.
+change_feed_poll_seconds = float(os.environ.get('CHANGE_FEED_POLL_SECONDS', 5))
+close_availability_max_age_seconds = float(
+    os.environ.get('CLOSE_AVAILABILITY_MAX_AGE_SECONDS', 5)
+)
+
+# How often a process that doesn't own a tenant checks whether the owner has
+# finished the sync it asked for.
+_shared_routing_state_poll_seconds = 0.05
+
 #######
 # Twilio
 #######
@@ -47,38 +77,26 @@ def twiml(resp):
     return resp
 
 
-def _fetch_worker_sid_to_worker_attributes_map():
+def call_path_deadline():
     """
-    Return a dictionary of Twilio Worker SIDs to useful attributes about the
-    worker:
-        friendly_name: The name of the Worker
-        activity_name: The current activity name the Worker has in Twilio. This
-            is the equivalent of the user's availability in Close and can have a
-            a value of online, offline, or on_call.
-        close_user_id: The Close User ID of the Twilio Worker.
-        groups: A list of groups that the Twilio Worker is a part of, taken
-        from Close.
+    Start the latency budget for a caller-facing request's upstream work,
+    which is the budget less the margin kept back for the response.
     """
-    worker_sid_to_attributes_map = {}
-    try:
-        all_workers = twilio_client.taskrouter.workspaces(
-            workspace_sid
-        ).workers.list()
-        for worker in all_workers:
-            worker_data = {
-                'friendly_name': worker.friendly_name,
-                'activity_name': worker.activity_name,
-            }
-            attributes = json.loads(worker.attributes)
-            if attributes.get('close_user_id'):
-                worker_data.update(attributes)
-            worker_sid_to_attributes_map[worker.sid] = worker_data
-    except Exception as e:
-        logging.error(
-            f"Failed to fetch a worker sid to attributes map because {str(e)}"
-        )
+    return Deadline(
+        max(call_path_budget_seconds - call_path_response_margin_seconds, 0)
+    )
+
 
-    return worker_sid_to_attributes_map
+def _iter_twilio_workers():
+    """
+    Stream a WorkerState for every Twilio Worker, fetching one page of
+    TWILIO_PAGE_SIZE workers at a time.
+    """
+    workers = current_tenant().workspace().workers.stream(
+        page_size=twilio_page_size
+    )
+    for worker in workers:
+        yield WorkerState.from_twilio(worker)
 
 
 def _fetch_queue_by_twilio_number(twilio_number):
@@ -95,7 +113,7 @@ def _fetch_queue_by_twilio_number(twilio_number):
     try:
         return [
             i
-            for i in config['queue_mappings']
+            for i in current_tenant().config['queue_mappings']
             if i['twilio_number'] == twilio_number
         ][0]
     except Exception:
@@ -122,11 +140,13 @@ def update_twilio_worker_status(worker_sid, new_status):
         new_status (str): The friendly_name of the worker's new status in Twilio
     """
     try:
-        activity_sid = config['twilio_status_mapping'].get(new_status)
+        activity_sid = current_tenant().config['twilio_status_mapping'].get(
+            new_status
+        )
         if activity_sid:
-            twilio_client.taskrouter.workspaces(workspace_sid).workers(
-                worker_sid
-            ).update(activity_sid=activity_sid)
+            current_tenant().workspace().workers(worker_sid).update(
+                activity_sid=activity_sid
+            )
         else:
             logging.error(
                 f"Failed when updating the status of {worker_sid} to {new_status} because the status does not exist"
@@ -144,15 +164,15 @@ def update_twilio_worker_groups_attribute(worker_sid, close_user_id, groups):
     Args:
         worker_sid (str): The worker's SID in Twilio
         close_user_id (str): The Close User ID of the current worker
-        groups (list): The list of user manager groups that this Worker is
+        groups (iterable): The user manager groups that this Worker is
         currently a part of in Close.
     """
     try:
-        attributes = {'close_user_id': close_user_id, 'groups': groups}
+        attributes = {'close_user_id': close_user_id, 'groups': sorted(groups)}
         attributes = json.dumps(attributes)
-        twilio_client.taskrouter.workspaces(workspace_sid).workers(
-            worker_sid
-        ).update(attributes=attributes)
+        current_tenant().workspace().workers(worker_sid).update(
+            attributes=attributes
+        )
     except Exception as e:
         logging.error(
             f"Failed updating {worker_sid}'s groups attribute because {str(e)}"
@@ -169,7 +189,7 @@ def create_twilio_worker(close_user_id, user_name):
     """
     try:
         attributes = {'close_user_id': close_user_id, 'groups': []}
-        twilio_client.taskrouter.workspaces(workspace_sid).workers.create(
+        current_tenant().workspace().workers.create(
             friendly_name=user_name, attributes=json.dumps(attributes)
         )
     except Exception as e:
@@ -187,9 +207,7 @@ def remove_twilio_worker_by_worker_sid(worker_sid):
         worker_sid: The SID of the worker being removed.
     """
     try:
-        twilio_client.taskrouter.workspaces(workspace_sid).workers(
-            worker_sid
-        ).delete()
+        current_tenant().workspace().workers(worker_sid).delete()
     except Exception as e:
         logging.error(
             f"Failed to delete a twilio worker with worker_sid {worker_sid} because {str(e)}"
@@ -197,7 +215,31 @@ def remove_twilio_worker_by_worker_sid(worker_sid):
         return str(e)
 
 
-def check_for_online_users_based_on_twilio_phone(phone):
+def _has_online_worker_in_group(group_id, deadline=None):
+    """
+    Whether any Twilio Worker in a Close group is not offline.
+
+    Args:
+        group_id (str): The Close group ID.
+        deadline (Deadline): Give up with DeadlineExceeded once this passes,
+            since the caller has stopped waiting.
+    """
+    # Stop paging through workers as soon as we find someone online.
+    for worker in _iter_twilio_workers():
+        if deadline and deadline.expired:
+            raise DeadlineExceeded(
+                f'Stopped looking for online workers in {group_id}'
+            )
+        if worker.close_user_id and worker.groups:
+            if (
+                group_id in worker.groups
+                and worker.activity is not Activity.OFFLINE
+            ):
+                return True
+    return False
+
+
+def check_for_online_users_based_on_twilio_phone(phone, deadline=None):
     """
     Check whether or not all users assigned to a specific TaskQueue are offline.
     If they are, we just forward to the group number in Close so that they can
@@ -206,36 +248,51 @@ def check_for_online_users_based_on_twilio_phone(phone):
     We do this instead of creating a "Queue" for Voicemail in Twilio because
     we want the voicemail to be logged in Close.
 
+    A sync that finished in the last ROUTING_STATE_MAX_AGE_SECONDS answers
+    without reading TaskRouter at all. Otherwise we read TaskRouter within the
+    deadline, and if that fails we fall back to the last known good state. With
+    no state at all we assume someone is online, since a queued caller can
+    still press a key to leave a voicemail.
+
     Args:
         phone (str): The phone number of the Twilio queue dialed into
+        deadline (Deadline): The latency budget for the check, if any.
 
     Returns:
         bool: True if users are online, false if all users are offline.
     """
+    queue_for_number = _fetch_queue_by_twilio_number(phone)
+    if not queue_for_number:
+        logging.error(
+            f'Could not check for Online users because a queue for {phone} does not exist.'
+        )
+        return False
+
+    group_id_for_queue = queue_for_number['close_user_manager_group_id']
+    routing_state = current_tenant().routing_state
+    fresh = routing_state.has_online_users(
+        group_id_for_queue, max_age=routing_state_max_age_seconds
+    )
+    if fresh is not None:
+        return fresh
+
     try:
-        queue_for_number = _fetch_queue_by_twilio_number(phone)
-        if not queue_for_number:
-            logging.error(
-                f'Could not check for Online users because a queue for {phone} does not exist.'
+        if deadline:
+            return run_with_deadline(
+                deadline,
+                _has_online_worker_in_group,
+                group_id_for_queue,
+                deadline,
+                executor=current_tenant().call_executor,
+                cancel=True,
             )
-            return False
-
-        group_id_for_queue = queue_for_number['close_user_manager_group_id']
-        twilio_workers = _fetch_worker_sid_to_worker_attributes_map()
-        for worker_sid, attributes in twilio_workers.items():
-            if attributes.get('close_user_id') and attributes.get('groups'):
-                if (
-                    group_id_for_queue in attributes['groups']
-                    and attributes['activity_name'] != 'offline'
-                ):
-                    return True
+        return _has_online_worker_in_group(group_id_for_queue)
     except Exception as e:
+        last_known = routing_state.has_online_users(group_id_for_queue)
         logging.error(
-            f"Failed when checking to see if any users were online for {phone} because {str(e)}"
+            f"Failed when checking to see if any users were online for {phone} because {str(e)}. Using the last known state: {last_known}"
         )
-        return False
-
-    return False
+        return True if last_known is None else last_known
 
 
 def mark_twilio_task_as_done_when_assigned(task_sid):
@@ -255,16 +312,16 @@ def mark_twilio_task_as_done_when_assigned(task_sid):
             complete.
     """
     try:
-        twilio_client.taskrouter.workspaces(workspace_sid).tasks(
-            task_sid
-        ).update(assignment_status='completed')
+        current_tenant().workspace().tasks(task_sid).update(
+            assignment_status='completed'
+        )
     except Exception as e:
         logging.error(
             f"Failed to mark task {task_sid} as complete because {str(e)}"
         )
 
 
-def send_call_to_queue(request):
+def send_call_to_queue(request, deadline=None):
     """
     Queue a Twilio call based on the number (queue) that was called. Before we
     use the enqueue verb, we double check to make sure someone is online.
@@ -276,7 +333,11 @@ def send_call_to_queue(request):
     to leave a voicemail at any time. If they choose to leave a voicemail,
     they will be redirected to a Close fallback number that goes directly to
     voicemail.
+
+    If anything goes wrong we still answer, by dialing the fallback number.
     """
+    tenant = current_tenant()
+    config = tenant.config
     response = VoiceResponse()
     try:
         to_number = request.values.get('To')
@@ -292,13 +353,17 @@ def send_call_to_queue(request):
         # If no one is online, but the queue exists dial the number directly so
         # that the caller can leave a voicemail.
         if (
-            not check_for_online_users_based_on_twilio_phone(to_number)
+            not check_for_online_users_based_on_twilio_phone(
+                to_number, deadline
+            )
             and queue
         ):
             response.dial(queue['close_group_number'])
 
         enqueue = response.enqueue(
-            None, workflow_sid=workflow_sid, wait_url='/wait-url/'
+            None,
+            workflow_sid=tenant.workflow_sid,
+            wait_url=tenant.url_path('/wait-url/'),
         )
         enqueue.task(json.dumps({'to_number': to_number}))
         response.dial(config['fallback_number'])
@@ -308,6 +373,9 @@ def send_call_to_queue(request):
         logging.error(
             f"Failed to correctly send a call to the correct desination because {str(e)}"
         )
+        response = VoiceResponse()
+        response.dial(config['fallback_number'])
+        return twiml(response)
 
 
 def send_redirect_instruction_on_assignment_callback(task_id, task_attributes):
@@ -323,7 +391,7 @@ def send_redirect_instruction_on_assignment_callback(task_id, task_attributes):
         response = {
             'instruction': 'redirect',
             'call_sid': task_attributes.get('call_sid'),
-            'url': f"{os.environ.get('BASE_URL')}redirect-task/?task_id={task_id}&phone_number={queue['close_group_number']}",
+            'url': f"{base_url.rstrip('/')}{current_tenant().url_path('/redirect-task/')}?task_id={task_id}&phone_number={queue['close_group_number']}",
             'accept': True,
         }
 
@@ -340,7 +408,7 @@ def send_redirect_instruction_on_assignment_callback(task_id, task_attributes):
         return str(e)
 
 
-def dial_redirected_phone_number(request):
+def dial_redirected_phone_number(request, deadline=None):
     """
     Handle the redirect instruction when it's sent on the assignment callback
     above.
@@ -348,11 +416,26 @@ def dial_redirected_phone_number(request):
     This method takes the phone_number that will be dialed and the task_id from
     the URL, marks the task as "complete" so that it doesn't remain in the queue
     after it redirects, and then calls the appropriate number.
+
+    If completing the task takes longer than the deadline allows, we dial
+    anyway and let it finish in the background.
     """
+    phone_number = request.args.get('phone_number')
+    task_id = request.args.get('task_id')
     try:
-        phone_number = request.args.get('phone_number')
-        task_id = request.args.get('task_id')
-        if task_id:
+        if task_id and deadline:
+            try:
+                run_with_deadline(
+                    deadline,
+                    mark_twilio_task_as_done_when_assigned,
+                    task_id,
+                    executor=current_tenant().call_executor,
+                )
+            except Exception as e:
+                logging.error(
+                    f"Dialing {phone_number} before task {task_id} was marked as complete because {str(e)}"
+                )
+        elif task_id:
             mark_twilio_task_as_done_when_assigned(task_id)
         response = VoiceResponse()
         if phone_number:
@@ -372,11 +455,14 @@ def setup_wait_url():
     the queue at any time and we also play a predetermined audio-file for hold
     music.
     """
+    tenant = current_tenant()
     response = VoiceResponse()
     with response.gather(
-        num_digits=1, action="/forward-to-vm/", method="POST"
+        num_digits=1, action=tenant.url_path('/forward-to-vm/'), method="POST"
     ) as g:
-        g.play(url_for('static', filename=config['hold_music_filename']))
+        g.play(
+            url_for('static', filename=tenant.config['hold_music_filename'])
+        )
     return twiml(response)
 
 
@@ -397,15 +483,13 @@ def ensure_all_memberships_have_workers():
     Make sure that every single active Close user in the given organization
     has a Twilio worker.
     """
-    twilio_workers = _fetch_worker_sid_to_worker_attributes_map()
-    existing_close_user_ids = {
-        attributes['close_user_id'] for k, attributes in twilio_workers.items()
-    }
     try:
-        memberships = api.get(
-            'organization/' + org_id, params={'_fields': 'memberships'}
-        )['memberships']
-        for membership in memberships:
+        existing_close_user_ids = {
+            worker.close_user_id
+            for worker in _iter_twilio_workers()
+            if worker.close_user_id
+        }
+        for membership in _iter_close_memberships():
             if membership['user_id'] not in existing_close_user_ids:
                 create_twilio_worker(
                     membership['user_id'], membership['user_full_name']
@@ -421,74 +505,276 @@ def process_close_group_update(group_id, group_members):
     """
     Process group updates by making sure Twilio Workers are in order.
 
-    When a new members update comes in for groups involved in a queue,
-    ensure that every user has a Twilio worker and that statuses in Twilio are
-    correct.
+    When a new members update comes in for groups involved in a queue, the
+    next sync first ensures that every user has a Twilio worker, then makes
+    sure statuses in Twilio are correct. With the change feed on, reading the
+    event log picks up the update along with any membership changes, so we
+    don't need to check every membership.
     """
     try:
         if group_id not in [
-            i['close_user_manager_group_id'] for i in config['queue_mappings']
+            i['close_user_manager_group_id']
+            for i in current_tenant().config['queue_mappings']
         ]:
             return False
 
         # On any group update that matters, make sure everyone's Twilio workers
         # are in order.
-        ensure_all_memberships_have_workers()
-        update_all_twilio_statuses_and_group_number_participants()
+        request_sync(check_memberships=True)
     except Exception as e:
         logging.error(
             f'Failed to proccess Close group update for {group_id} because {str(e)}'
         )
 
 
+def _iter_close_pages(endpoint, params=None):
+    """
+    Stream the records of a paginated Close list endpoint, fetching
+    CLOSE_PAGE_SIZE records at a time with `_skip` and `_limit` until
+    `has_more` is false.
+    """
+    params = dict(params or {}, _limit=close_page_size)
+    skip = 0
+    while True:
+        resp = current_tenant().api.get(
+            endpoint, params=dict(params, _skip=skip)
+        )
+        yield from resp['data']
+        if not resp.get('has_more') or not resp['data']:
+            return
+        skip += len(resp['data'])
+
+
+def _iter_close_memberships():
+    """
+    Stream the active memberships of the organization.
+
+    Close only returns memberships embedded in the organization object, so
+    this is a single request, but callers consume it as a stream like every
+    other fetch. With the change feed on, no request is needed at all.
+    """
+    tenant = current_tenant()
+    if _change_feed_started():
+        for user_id, user_full_name in list(
+            tenant.change_feed.memberships.items()
+        ):
+            # Membership events don't always carry the user's name, and
+            # Twilio needs one to create a Worker.
+            yield {
+                'user_id': user_id,
+                'user_full_name': user_full_name or user_id,
+            }
+        return
+    yield from tenant.api.get(
+        'organization/' + tenant.org_id, params={'_fields': 'memberships'}
+    )['memberships']
+
+
 def _fetch_user_id_to_close_availability_map():
     """
-    Return a dictionary of User ID to availability status in Close. The
+    Return a dictionary of User ID to availability Activity in Close. The
     possible values are:
-     - online: The user is online in the native application
-     - offline: The user is offline in the native application
-     - on_call: The user is currently on a call in Close
+     - ONLINE: The user is online in the native application
+     - OFFLINE: The user is offline in the native application
+     - ON_CALL: The user is currently on a call in Close
+
+    Returns None if availability couldn't be pulled, so that a failed read is
+    never mistaken for everyone being offline.
     """
     user_availability_map = {}
     try:
-        current_availability = api.get(
-            'user/availability', params={'organization_id': org_id}
+        current_availability = _iter_close_pages(
+            'user/availability',
+            params={'organization_id': current_tenant().org_id},
         )
-        for user in current_availability['data']:
+        for user in current_availability:
             native_app_availability = [
                 i for i in user['availability'] if i['type'] == 'native'
             ][0]
             status = native_app_availability.get('status', 'offline')
             if native_app_availability.get('active_calls', []):
                 status = 'on_call'
-            user_availability_map[user['user_id']] = status
+            user_availability_map[intern_id(user['user_id'])] = (
+                Activity.from_name(status)
+            )
     except Exception as e:
         logging.error(f'Could not pull user availability map because {str(e)}')
+        return None
     return user_availability_map
 
 
 def _fetch_group_id_group_users_map():
     """
-    Returns a dictionary of group_id to list of user_ids currently in that
-    group.
+    Returns a dictionary of group_id to a frozenset of user_ids currently in
+    that group.
 
-    We get our group_id list from config.json.
+    We get our group_id list from config.json. Returns None if the groups
+    couldn't be pulled.
     """
+    tenant = current_tenant()
     group_members_mapping = {}
     try:
         groups = [
-            i['close_user_manager_group_id'] for i in config['queue_mappings']
+            i['close_user_manager_group_id']
+            for i in tenant.config['queue_mappings']
         ]
         for group in groups:
-            resp = api.get(f'group/{group}', params={'_fields': 'members'})[
-                'members'
-            ]
-            group_members_mapping[group] = [i['user_id'] for i in resp]
+            resp = tenant.api.get(
+                f'group/{group}', params={'_fields': 'members'}
+            )['members']
+            group_members_mapping[intern_id(group)] = frozenset(
+                intern_id(i['user_id']) for i in resp
+            )
     except Exception as e:
         logging.error(f'Could not pull groups to users map because {str(e)}')
+        return None
     return group_members_mapping
 
 
+def _connect_tenant():
+    """
+    Look up the current tenant's Close organization and set up its change
+    feed, if that hasn't been done yet. Raises if Close can't be read.
+    """
+    tenant = current_tenant()
+    if tenant.org_id is not None:
+        return
+    org_id = tenant.api.get('api_key/' + tenant.close_api_key)[
+        'organization_id'
+    ]
+    if tenant.change_feed_path:
+        tenant.change_feed = ChangeFeed(
+            tenant.api,
+            org_id,
+            [
+                i['close_user_manager_group_id']
+                for i in tenant.config['queue_mappings']
+            ],
+            tenant.change_feed_path,
+            poll_interval=change_feed_poll_seconds,
+            page_size=close_page_size,
+        )
+    tenant.org_id = org_id
+
+
+def _change_feed_started():
+    """Whether the change feed is on and has state to work from."""
+    change_feed = current_tenant().change_feed
+    return change_feed is not None and change_feed.started
+
+
+def _poll_change_feed(force=False):
+    """
+    Start the change feed if it hasn't been yet and apply new Close events:
+    Twilio Workers are created and removed for membership changes, and call
+    events mean availability has to be read again.
+    """
+    tenant = current_tenant()
+    if not _change_feed_started():
+        tenant.change_feed.start()
+    changes = tenant.change_feed.poll(force=force)
+    if not changes:
+        return
+    if changes.calls:
+        tenant.cached_close_availability = None
+    if changes.members_added:
+        existing_close_user_ids = {
+            worker.close_user_id
+            for worker in _iter_twilio_workers()
+            if worker.close_user_id
+        }
+        for user_id, user_full_name in changes.members_added.items():
+            if user_id not in existing_close_user_ids:
+                create_twilio_worker(user_id, user_full_name or user_id)
+    for user_id in changes.members_removed:
+        delete_twilio_worker_from_close_user_id(user_id)
+
+
+def _fetch_group_id_group_users_map_for_sync():
+    """
+    The group_id to user_ids map from the change feed when it's on, falling
+    back to downloading every group when it isn't or can't be read.
+    """
+    change_feed = current_tenant().change_feed
+    if change_feed is not None:
+        try:
+            _poll_change_feed()
+            return dict(change_feed.group_users)
+        except Exception as e:
+            logging.error(
+                f'Downloading Close groups because the change feed failed because {str(e)}'
+            )
+    return _fetch_group_id_group_users_map()
+
+
+def _fetch_user_id_to_close_availability_map_for_sync():
+    """
+    Close availability for a sync. With the change feed on, availability read
+    in the last CLOSE_AVAILABILITY_MAX_AGE_SECONDS is reused unless a call has
+    been made since.
+    """
+    tenant = current_tenant()
+    cached = tenant.cached_close_availability
+    if tenant.change_feed is not None and cached is not None:
+        user_availability_map, fetched_at = cached
+        if time.monotonic() - fetched_at < close_availability_max_age_seconds:
+            return user_availability_map
+    user_availability_map = _fetch_user_id_to_close_availability_map()
+    if user_availability_map is not None:
+        tenant.cached_close_availability = (
+            user_availability_map,
+            time.monotonic(),
+        )
+    return user_availability_map
+
+
+def _ensure_memberships_if_requested():
+    """
+    Make sure every membership has a Twilio Worker if a group update asked
+    for it since the last sync, or the last attempt failed.
+    """
+    tenant = current_tenant()
+    if not tenant.check_memberships:
+        return
+    tenant.check_memberships = False
+    if _change_feed_started():
+        try:
+            _poll_change_feed(force=True)
+            return
+        except Exception as e:
+            logging.error(
+                f'Checking every membership because the change feed failed because {str(e)}'
+            )
+    if not ensure_all_memberships_have_workers():
+        tenant.check_memberships = True
+
+
+def _user_id_to_groups_map(groups_to_users_map):
+    """
+    Invert a group_id to user_ids map into a user_id to frozenset of group_ids
+    map. Users with the same groups share one frozenset.
+    """
+    user_id_to_groups = {}
+    for group, user_ids in groups_to_users_map.items():
+        for user_id in user_ids:
+            user_id_to_groups.setdefault(user_id, set()).add(group)
+    return {k: intern_groups(v) for k, v in user_id_to_groups.items()}
+
+
+def _update_twilio_worker_groups_from_close_groups(worker, user_id_to_groups):
+    """
+    Update a single Twilio Worker's groups attribute if it doesn't match the
+    groups its Close user is currently in.
+    """
+    if not worker.close_user_id:
+        return
+    worker_groups = user_id_to_groups.get(worker.close_user_id, frozenset())
+    if worker.groups != worker_groups:
+        update_twilio_worker_groups_attribute(
+            worker.sid, worker.close_user_id, worker_groups
+        )
+
+
 def update_groups_attribute_for_twilio_workers_from_list_of_users_in_close_groups(
     groups_to_users_map=None, twilio_workers=None
 ):
@@ -498,35 +784,14 @@ def update_groups_attribute_for_twilio_workers_from_list_of_users_in_close_group
     listed on their Twilio Workers.
     """
     try:
-        twilio_workers = (
-            twilio_workers or _fetch_worker_sid_to_worker_attributes_map()
-        )
         groups_to_users_map = (
             groups_to_users_map or _fetch_group_id_group_users_map()
         )
-        close_user_ids_to_twilio_worker_ids = {
-            attributes['close_user_id']: k
-            for k, attributes in twilio_workers.items()
-        }
-        twilio_worker_to_group_mappings = {
-            k: [] for k, attributes in twilio_workers.items()
-        }
-        for group, user_ids in groups_to_users_map.items():
-            for user_id in user_ids:
-                worker_id = close_user_ids_to_twilio_worker_ids.get(
-                    user_id, None
-                )
-                if worker_id:
-                    twilio_worker_to_group_mappings[worker_id].append(group)
-
-        for k, attributes in twilio_workers.items():
-            worker_groups = twilio_worker_to_group_mappings.get(k, [])
-            if not attributes.get('groups') or sorted(
-                attributes.get('groups', [])
-            ) != sorted(worker_groups):
-                update_twilio_worker_groups_attribute(
-                    k, attributes['close_user_id'], worker_groups
-                )
+        user_id_to_groups = _user_id_to_groups_map(groups_to_users_map)
+        for worker in twilio_workers or _iter_twilio_workers():
+            _update_twilio_worker_groups_from_close_groups(
+                worker, user_id_to_groups
+            )
     except Exception as e:
         logging.error(
             f"Failed to update groups attribute for Twilio Workers from a Close list because {str(e)}"
@@ -544,11 +809,12 @@ def delete_twilio_worker_from_close_user_id(user_id):
         user_id: The user_id of the User that was deactivated in Close
     """
     try:
-        twilio_workers = _fetch_worker_sid_to_worker_attributes_map()
-        for worker_sid, attributes in twilio_workers.items():
-            if attributes['close_user_id'] == user_id:
-                update_twilio_worker_status(worker_sid, 'offline')
-                remove_twilio_worker_by_worker_sid(worker_sid)
+        for worker in _iter_twilio_workers():
+            if worker.close_user_id == user_id:
+                update_twilio_worker_status(
+                    worker.sid, Activity.OFFLINE.value
+                )
+                remove_twilio_worker_by_worker_sid(worker.sid)
     except Exception as e:
         logging.error(
             f"Failed to delete worker for {user_id} because {str(e)}"
@@ -556,13 +822,56 @@ def delete_twilio_worker_from_close_user_id(user_id):
         return str(e)
 
 
+def _update_close_group_number_participants(queue, expected_participants):
+    """
+    Make a queue's Close group number ring exactly the expected participants.
+
+    The current participants come from the participant cache when it's fresh,
+    and from Close otherwise. Anything we PUT is written through to the cache.
+
+    Args:
+        queue (dict): The queue config.
+        expected_participants (frozenset): The user IDs that should be rung.
+    """
+    tenant = current_tenant()
+    participant_cache = tenant.participant_cache
+    phone_number_id = queue['close_group_number_id']
+    try:
+        participants_currently_in_close = participant_cache.get(
+            phone_number_id
+        )
+        if participants_currently_in_close is None:
+            participants_currently_in_close = frozenset(
+                tenant.api.get(
+                    f"phone_number/{phone_number_id}",
+                    params={'_fields': 'participants'},
+                )['participants']
+            )
+            participant_cache.verified(
+                phone_number_id, participants_currently_in_close
+            )
+        if expected_participants != participants_currently_in_close:
+            tenant.api.put(
+                f"phone_number/{phone_number_id}",
+                data={'participants': sorted(expected_participants)},
+            )
+            participant_cache.written(phone_number_id, expected_participants)
+    except Exception as e:
+        # We no longer know what Close has, so read it again next time.
+        participant_cache.invalidate(phone_number_id)
+        logging.error(
+            f"Failed to update participants for {phone_number_id} because {str(e)}"
+        )
+
+
 def update_close_group_number_participants_from_availability(
     user_availability_map=None, groups_to_users_map=None
 ):
     """
     Update Close group number participants for each queue based on the current
-    availability of each User in Close.
+    availability of each User in Close. Queues are updated concurrently.
     """
+    tenant = current_tenant()
     try:
         user_availability_map = (
             user_availability_map or _fetch_user_id_to_close_availability_map()
@@ -570,32 +879,48 @@ def update_close_group_number_participants_from_availability(
         groups_to_users_map = (
             groups_to_users_map or _fetch_group_id_group_users_map()
         )
-        for queue in config['queue_mappings']:
+        futures = []
+        for queue in tenant.config['queue_mappings']:
             user_ids_in_group = groups_to_users_map.get(
                 queue['close_user_manager_group_id'], []
             )
-            expected_participants = [
+            expected_participants = frozenset(
                 user_id
                 for user_id in user_ids_in_group
-                if user_availability_map.get(user_id, 'offline') == 'online'
-            ]
-            participants_currently_in_close = api.get(
-                f"phone_number/{queue['close_group_number_id']}",
-                params={'_fields': 'participants'},
-            )['participants']
-            if sorted(expected_participants) != sorted(
-                participants_currently_in_close
-            ):
-                api.put(
-                    f"phone_number/{queue['close_group_number_id']}",
-                    data={'participants': expected_participants},
+                if user_availability_map.get(user_id, Activity.OFFLINE)
+                is Activity.ONLINE
+            )
+            futures.append(
+                submit(
+                    _update_close_group_number_participants,
+                    queue,
+                    expected_participants,
+                    executor=tenant.group_number_executor,
                 )
+            )
+        for future in futures:
+            future.result()
     except Exception as e:
         logging.error(
             f"Failed to update Close group number participants because {str(e)}"
         )
 
 
+def _update_twilio_worker_status_from_close_status(
+    worker, user_availability_map
+):
+    """
+    Update a single Twilio Worker's status if it doesn't match its Close user's
+    availability.
+    """
+    if worker.close_user_id:
+        user_status_in_close = user_availability_map.get(
+            worker.close_user_id, Activity.OFFLINE
+        )
+        if worker.activity is not user_status_in_close:
+            update_twilio_worker_status(worker.sid, user_status_in_close.value)
+
+
 def update_twilio_worker_statuses_from_close_status(
     user_availability_map=None, twilio_workers=None
 ):
@@ -611,44 +936,229 @@ def update_twilio_worker_statuses_from_close_status(
         user_availability_map = (
             user_availability_map or _fetch_user_id_to_close_availability_map()
         )
-        twilio_workers = (
-            twilio_workers or _fetch_worker_sid_to_worker_attributes_map()
-        )
-        for worker_sid, twilio_attributes in twilio_workers.items():
-            user_id = twilio_attributes.get('close_user_id', None)
-            if user_id:
-                user_status_in_close = user_availability_map.get(
-                    user_id, 'offline'
-                )
-                if twilio_attributes['activity_name'] != user_status_in_close:
-                    update_twilio_worker_status(
-                        worker_sid, user_status_in_close
-                    )
+        for worker in twilio_workers or _iter_twilio_workers():
+            _update_twilio_worker_status_from_close_status(
+                worker, user_availability_map
+            )
     except Exception as e:
         logging.error(
             f"Failed to update Twilio worker statuses by Close availability because {str(e)}"
         )
 
 
+@profiled('sync')
 def update_all_twilio_statuses_and_group_number_participants():
     """
     Updates Twilio Worker Status and Close Group Number participants based on
     current availability status in Close.
+
+    Twilio Workers are streamed a page at a time and each one has its status
+    and groups attribute diffed as it arrives, so we never hold every worker in
+    memory at once. A complete pass records which groups have someone
+    available as the last known good routing state.
     """
-    close_availability = _fetch_user_id_to_close_availability_map()
-    group_users = _fetch_group_id_group_users_map()
-    twilio_workers = _fetch_worker_sid_to_worker_attributes_map()
-    update_twilio_worker_statuses_from_close_status(
-        user_availability_map=close_availability, twilio_workers=twilio_workers
-    )
-    update_close_group_number_participants_from_availability(
-        user_availability_map=close_availability,
-        groups_to_users_map=group_users,
-    )
-    update_groups_attribute_for_twilio_workers_from_list_of_users_in_close_groups(
-        groups_to_users_map=group_users, twilio_workers=twilio_workers
-    )
+    try:
+        _connect_tenant()
+    except Exception as e:
+        logging.error(
+            f"Skipped updating Twilio Workers and Close group numbers because the Close organization could not be read because {str(e)}"
+        )
+        return
+    _ensure_memberships_if_requested()
+    with profiled('fetch_close_groups'):
+        group_users = _fetch_group_id_group_users_map_for_sync()
+    with profiled('fetch_close_availability'):
+        close_availability = _fetch_user_id_to_close_availability_map_for_sync()
+    if close_availability is None or group_users is None:
+        logging.error(
+            "Skipped updating Twilio Workers and Close group numbers because Close could not be read"
+        )
+        return
+    user_id_to_groups = _user_id_to_groups_map(group_users)
+    with profiled('sync_twilio_workers'):
+        try:
+            online_groups = set()
+            for worker in _iter_twilio_workers():
+                _update_twilio_worker_status_from_close_status(
+                    worker, close_availability
+                )
+                _update_twilio_worker_groups_from_close_groups(
+                    worker, user_id_to_groups
+                )
+                if (
+                    worker.close_user_id
+                    and close_availability.get(
+                        worker.close_user_id, Activity.OFFLINE
+                    )
+                    is not Activity.OFFLINE
+                ):
+                    online_groups |= user_id_to_groups.get(
+                        worker.close_user_id, frozenset()
+                    )
+            current_tenant().routing_state.update(online_groups)
+        except Exception as e:
+            logging.error(
+                f"Failed to update Twilio Workers from Close because {str(e)}"
+            )
+    with profiled('update_group_numbers'):
+        update_close_group_number_participants_from_availability(
+            user_availability_map=close_availability,
+            groups_to_users_map=group_users,
+        )
+
+
+def _start_sync(rerun=False):
+    """
+    Start a full sync of the current tenant in the background, or join the
+    one that is already running, so that a burst of calls triggers one sync
+    instead of one each.
+
+    With `rerun`, a sync that is already running is followed by another one,
+    since it may have read Close before whatever we're syncing for happened.
+    Every rerun requested while that one is waiting shares it.
+    """
+    tenant = current_tenant()
+    with tenant.sync_lock:
+        latest = tenant.sync_in_flight
+        if latest is None or latest.done() or (rerun and latest.running()):
+            latest = tenant.sync_in_flight = submit(
+                update_all_twilio_statuses_and_group_number_participants,
+                executor=tenant.sync_executor,
+            )
+        return latest
+
+
+def request_sync(invalidate_close_availability=False, check_memberships=False):
+    """
+    Sync the current tenant in the background after a Close webhook. If
+    another process owns the tenant, the request is passed on to it.
+
+    Args:
+        invalidate_close_availability (bool): Read Close availability again,
+            e.g. after a call ends.
+        check_memberships (bool): Make sure every membership has a Twilio
+            Worker before syncing, e.g. after a group update.
+    """
+    tenant = current_tenant()
+    if not tenant.owned:
+        kinds = []
+        if invalidate_close_availability:
+            kinds.append(shards.INVALIDATE_CLOSE_AVAILABILITY)
+        if check_memberships:
+            kinds.append(shards.CHECK_MEMBERSHIPS)
+        shards.request(tenant.id, *kinds)
+        return
+    if invalidate_close_availability:
+        tenant.cached_close_availability = None
+    if check_memberships:
+        tenant.check_memberships = True
+    _start_sync(rerun=True)
+
+
+def _on_sync_request(tenant_id, kinds):
+    """Handle a sync request passed on by another process."""
+    with tenants[tenant_id].activated():
+        request_sync(
+            invalidate_close_availability=shards.INVALIDATE_CLOSE_AVAILABILITY
+            in kinds,
+            check_memberships=shards.CHECK_MEMBERSHIPS in kinds,
+        )
+
+
+def _wait_for_shared_routing_state(timeout):
+    """
+    Ask the process that owns the current tenant to sync it, and wait up to
+    `timeout` seconds for the routing state it shares to be updated.
+    """
+    tenant = current_tenant()
+    requested_at = time.time()
+    shards.request(tenant.id)
+    give_up_at = time.monotonic() + timeout
+    while True:
+        updated_at = tenant.routing_state.updated_at()
+        if updated_at is not None and updated_at >= requested_at:
+            return True
+        if time.monotonic() >= give_up_at:
+            logging.error(
+                "Routing a call without waiting for the sync to finish because the shard that owns the tenant didn't finish it in time"
+            )
+            return False
+        time.sleep(_shared_routing_state_poll_seconds)
+
+
+def sync_within_deadline(deadline):
+    """
+    Run a full sync for a caller-facing request, waiting for at most half of
+    the remaining budget so there is time left to route the call. If the sync
+    doesn't finish in time it carries on in the background.
+
+    When the routing state is fresh enough to route from, the sync only runs
+    in the background and nothing waits for it.
+
+    Returns:
+        bool: True if the sync finished within the deadline, or wasn't
+        needed.
+    """
+    tenant = current_tenant()
+    updated_at = tenant.routing_state.updated_at()
+    if (
+        updated_at is not None
+        and time.time() - updated_at < routing_state_max_age_seconds
+    ):
+        if tenant.owned:
+            _start_sync()
+        else:
+            shards.request(tenant.id)
+        return True
+    if not tenant.owned:
+        return _wait_for_shared_routing_state(deadline.remaining() / 2)
+    future = _start_sync()
+    try:
+        future.result(timeout=deadline.remaining() / 2)
+        return True
+    except Exception as e:
+        logging.error(
+            f"Routing a call without waiting for the sync to finish because {str(e) or type(e).__name__}"
+        )
+        return False
 
 
-ensure_all_memberships_have_workers()
-update_all_twilio_statuses_and_group_number_participants()
+def _start_tenant():
+    """
+    Connect the current tenant, start its change feed, make sure every
+    membership has a Twilio Worker and run a first sync. Whatever fails is
+    retried by the next sync.
+    """
+    tenant = current_tenant()
+    try:
+        _connect_tenant()
+    except Exception as e:
+        logging.error(
+            f'Failed to look up the Close organization on startup because {str(e)}'
+        )
+        tenant.check_memberships = True
+        return
+    change_feed = tenant.change_feed
+    if change_feed is not None:
+        try:
+            change_feed.start()
+        except Exception as e:
+            logging.error(
+                f'Failed to start the Close change feed because {str(e)}'
+            )
+    if not ensure_all_memberships_have_workers():
+        tenant.check_memberships = True
+    update_all_twilio_statuses_and_group_number_participants()
+
+
+# Each tenant this process owns starts on its own sync thread, so a tenant
+# whose vendors are slow to answer doesn't hold up the others. Calls that come
+# in before the first sync finishes join it.
+for _tenant in tenants.values():
+    if _tenant.owned:
+        with _tenant.activated():
+            _tenant.sync_in_flight = submit(
+                _start_tenant, executor=_tenant.sync_executor
+            )
+if shards.is_sharded():
+    shards.watch([i.id for i in tenants.values() if i.owned], _on_sync_request)
@@ -0,0 +1,282 @@
+import cProfile
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from . import shards
+from .state import save_json
+
+COLLAPSED = 'collapsed'
+PSTATS = 'pstats'
+
+
+class ProfilingSettings:
+    """
+    Profiling settings, read from the environment at startup and changeable
+    at runtime through the admin endpoint.
+
+    Runtime changes are saved to a file in the shard state directory, which
+    every worker process started by the same gunicorn master picks up within
+    a second, so they apply whichever worker syncs a tenant.
+
+    Attributes:
+        sample_rate (float): Fraction of requests and syncs to profile, 0 to 1.
+        mode (str): 'collapsed' for a low-overhead stack sampler writing
+            collapsed stacks (flamegraph.pl / speedscope input), or 'pstats'
+            for cProfile output.
+        directory (str): Where profiles are written. Only set from the
+            environment.
+        interval (float): Seconds between stack samples in collapsed mode.
+    """
+
+    def __init__(self):
+        self.sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+        self.mode = os.environ.get('PROFILE_MODE', COLLAPSED)
+        self.directory = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+        self.interval = float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000
+        self.path = os.path.join(shards.state_dir, 'profiling.json')
+        self._checked_at = None
+        self._loaded_mtime = None
+
+    def update(self, sample_rate=None, mode=None, interval_ms=None):
+        """Change the settings of every worker process."""
+        self._apply(sample_rate, mode, interval_ms)
+        os.makedirs(shards.state_dir, exist_ok=True)
+        save_json(
+            self.path,
+            {
+                # Only workers of this gunicorn master use the file, so a
+                # restart goes back to the environment's settings.
+                'master_pid': os.getppid(),
+                'sample_rate': self.sample_rate,
+                'mode': self.mode,
+                'interval_ms': self.interval * 1000,
+            },
+        )
+        self._loaded_mtime = os.stat(self.path).st_mtime_ns
+
+    def refresh(self):
+        """Pick up changes made by other processes, at most once a second."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < 1:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._loaded_mtime:
+                return
+            with open(self.path) as f:
+                saved = json.load(f)
+            self._loaded_mtime = mtime
+            if saved.get('master_pid') == os.getppid():
+                self._apply(
+                    saved['sample_rate'], saved['mode'], saved['interval_ms']
+                )
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(
+                f'Failed to read the profiling settings in {self.path} because {str(e)}'
+            )
+
+    def _apply(self, sample_rate=None, mode=None, interval_ms=None):
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+            if not 0 <= sample_rate <= 1:
+                raise ValueError('sample_rate must be between 0 and 1')
+        if mode is not None and mode not in (COLLAPSED, PSTATS):
+            raise ValueError(f'mode must be {COLLAPSED} or {PSTATS}')
+        if interval_ms is not None:
+            interval_ms = float(interval_ms)
+            if interval_ms <= 0:
+                raise ValueError('interval_ms must be positive')
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if mode is not None:
+            self.mode = mode
+        if interval_ms is not None:
+            self.interval = interval_ms / 1000
+
+    def as_dict(self):
+        return {
+            'sample_rate': self.sample_rate,
+            'mode': self.mode,
+            'directory': self.directory,
+            'interval_ms': self.interval * 1000,
+            'pid': os.getpid(),
+        }
+
+
+settings = ProfilingSettings()
+
+# The profiling sessions open on each thread, outermost first.
+_local = threading.local()
+
+# Numbers each profile written by this process, so no two share a file name.
+_profile_numbers = itertools.count()
+
+
+class _Session:
+    def __init__(self, label, mode, skip):
+        self.label = label
+        self.mode = mode
+        # Frames above the profiled block that samples should leave out.
+        self.skip = skip
+        self.counts = Counter()
+        self.profile = cProfile.Profile() if mode == PSTATS else None
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory,
+            f'{self.label}.{int(time.time() * 1000)}.{os.getpid()}.'
+            f'{next(_profile_numbers)}.{self.mode}',
+        )
+        if self.profile:
+            self.profile.dump_stats(path)
+        else:
+            with open(path, 'w') as f:
+                for stack, count in self.counts.items():
+                    f.write(f'{self.label};{stack} {count}\n')
+        return path
+
+
+class _StackSampler:
+    """
+    A background thread that samples the stacks of threads with an open
+    collapsed-mode session every `settings.interval` seconds. It sleeps while
+    nothing is being profiled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._sessions = {}
+        self._thread = None
+
+    def add(self, thread_id, session):
+        with self._lock:
+            self._sessions.setdefault(thread_id, []).append(session)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='stack-sampler', daemon=True
+                )
+                self._thread.start()
+            self._lock.notify()
+
+    def remove(self, thread_id, session):
+        with self._lock:
+            sessions = self._sessions.get(thread_id, [])
+            if session in sessions:
+                sessions.remove(session)
+            if not sessions:
+                self._sessions.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._sessions:
+                    self._lock.wait()
+            frames = sys._current_frames()
+            # Count while holding the lock, so a session never gains samples
+            # once it has been removed and is being written.
+            with self._lock:
+                for thread_id, sessions in self._sessions.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = _frame_names(frame)
+                    for session in sessions:
+                        session.counts[';'.join(stack[session.skip :])] += 1
+            del frames
+            time.sleep(settings.interval)
+
+
+_sampler = _StackSampler()
+
+
+def _frame_names(frame):
+    """The frames of a stack as 'file:function' names, outermost first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def _stack_depth(frame):
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+@contextmanager
+def profiled(label):
+    """
+    Profile a block (or, as a decorator, a function) for a sampled fraction of
+    calls, writing one profile per sampled call to `settings.directory`.
+
+    Blocks nested in a sampled block are always profiled too and written to
+    their own file labelled `parent.child`, so a sampled sync produces one
+    profile for the whole sync and one for each of its phases. In pstats mode
+    the parent's profile excludes the time spent in its children.
+
+    Args:
+        label (str): Names the output file, e.g. the route or sync phase.
+    """
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = []
+    if not sessions:
+        settings.refresh()
+    if not sessions and (
+        settings.sample_rate <= 0 or random.random() >= settings.sample_rate
+    ):
+        yield
+        return
+
+    label = re.sub(r'[^\w.-]+', '-', label).strip('-')
+    if sessions:
+        label = f'{sessions[-1].label}.{label}'
+        mode = sessions[-1].mode
+    else:
+        mode = settings.mode
+    # Leave out the frames above whoever opened this block: this generator
+    # and contextlib's __enter__ sit between us and them.
+    skip = max(_stack_depth(sys._getframe(2)) - 1, 0)
+    session = _Session(label, mode, skip)
+    parent = sessions[-1] if sessions else None
+    sessions.append(session)
+
+    thread_id = threading.get_ident()
+    if mode == PSTATS:
+        if parent:
+            parent.profile.disable()
+        session.profile.enable()
+    else:
+        _sampler.add(thread_id, session)
+    try:
+        yield
+    finally:
+        if mode == PSTATS:
+            session.profile.disable()
+            if parent:
+                parent.profile.enable()
+        else:
+            _sampler.remove(thread_id, session)
+        sessions.pop()
+        try:
+            session.write(settings.directory)
+        except Exception as e:
+            logging.error(f'Failed to write the {label} profile because {str(e)}')
@@ -0,0 +1,271 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from closeio_api import APIError
+from closeio_api import Client as CloseIO_API
+from closeio_api import ValidationError
+from twilio.http.http_client import TwilioHttpClient
+
+# Threads that run upstream work on behalf of a caller-facing request, so the
+# request can stop waiting when its deadline passes even if the upstream call
+# is still in flight.
+_executor = ThreadPoolExecutor(max_workers=16)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when work doesn't finish before the caller's deadline."""
+
+
+class Deadline:
+    """A latency budget that starts counting down when it's created."""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def submit(fn, *args, executor=None, **kwargs):
+    """
+    Run `fn` on `executor` (the shared upstream thread pool by default) and
+    return its future. `fn` runs in a copy of the caller's context, so it
+    works on behalf of the same tenant.
+    """
+    context = contextvars.copy_context()
+    return (executor or _executor).submit(context.run, fn, *args, **kwargs)
+
+
+def run_with_deadline(
+    deadline, fn, *args, executor=None, cancel=False, **kwargs
+):
+    """
+    Run `fn` and return its result, waiting no longer than the deadline allows.
+
+    The work keeps running in the background if the deadline passes, but the
+    caller gets DeadlineExceeded straight away. With `cancel`, work that is
+    still queued by then is dropped instead: use it for reads nobody else
+    needs the result of, so a slow upstream doesn't build up a backlog of
+    them.
+    """
+    if deadline.expired:
+        raise DeadlineExceeded(f'No time left to call {fn.__name__}')
+    future = submit(fn, *args, executor=executor, **kwargs)
+    try:
+        return future.result(timeout=deadline.remaining())
+    except FutureTimeoutError:
+        if cancel:
+            future.cancel()
+        raise DeadlineExceeded(f'{fn.__name__} did not finish in time')
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream after it fails `failure_threshold` times in a row.
+
+    While the circuit is open every call fails fast with CircuitOpenError.
+    After `reset_timeout` seconds one trial call is let through: if it
+    succeeds the circuit closes again, otherwise it stays open for another
+    `reset_timeout`. A trial that never reports back is replaced by another
+    one after `reset_timeout`.
+
+    Successes of calls that started before the circuit last opened say
+    nothing about the upstream now, so they don't close it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_at = None
+
+    @property
+    def state(self):
+        return self._state
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the upstream shouldn't be called now.
+
+        Returns:
+            float: The time.monotonic() the call started, to pass to
+            record_success.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.CLOSED:
+                return now
+            if (
+                self._state == self.OPEN
+                and now - self._opened_at >= self.reset_timeout
+            ) or (
+                self._state == self.HALF_OPEN
+                and now - self._trial_at >= self.reset_timeout
+            ):
+                self._state = self.HALF_OPEN
+                self._trial_at = now
+                return now
+            raise CircuitOpenError(f'The {self.name} circuit is open')
+
+    def record_success(self, started_at=None):
+        with self._lock:
+            if (
+                started_at is not None
+                and self._opened_at is not None
+                and started_at < self._opened_at
+            ):
+                return
+            if self._state != self.CLOSED:
+                logging.info(f'The {self.name} circuit closed')
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (
+                self._state == self.HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                if self._state != self.OPEN:
+                    logging.error(
+                        f'The {self.name} circuit opened after {self._failures} failures'
+                    )
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """
+    A token bucket that lets `rate` requests a second through on average, in
+    bursts of up to `burst`. Requests over the limit wait their turn.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            # Take a token even if there isn't one yet, so that waiting
+            # requests go through in the order they arrived.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _is_upstream_failure(status_code):
+    """Rate limits and server errors count against an upstream's health."""
+    return status_code == 429 or status_code >= 500
+
+
+class CloseClient(CloseIO_API):
+    """
+    A Close API client whose requests go through a circuit breaker and, if
+    given one, a rate limiter.
+
+    Each request is sent once. closeio_api's own retry loop sleeps for up to
+    minutes on rate limits and server errors, which would hold up the caller
+    and count a whole run of failures as one; the next sync retries instead.
+    """
+
+    def __init__(
+        self, api_key, breaker, timeout=None, rate_limiter=None, **kwargs
+    ):
+        super().__init__(api_key, **kwargs)
+        self.breaker = breaker
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+
+    def _dispatch(
+        self,
+        method_name,
+        endpoint,
+        api_key=None,
+        data=None,
+        debug=False,
+        timeout=None,
+        **kwargs,
+    ):
+        started_at = self.breaker.before_call()
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        try:
+            request = self._prepare_request(
+                method_name, endpoint, api_key, data, debug, **kwargs
+            )
+            response = self.session.send(
+                request, verify=self.verify, timeout=timeout or self.timeout
+            )
+            if response.status_code == 400:
+                raise ValidationError(response)
+            if not response.ok:
+                raise APIError(response)
+            result = response.json()
+        except APIError as e:
+            if _is_upstream_failure(e.response.status_code):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success(started_at)
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success(started_at)
+        return result
+
+
+class BreakerTwilioHttpClient(TwilioHttpClient):
+    """
+    A Twilio HTTP client whose requests go through a circuit breaker and, if
+    given one, a rate limiter.
+    """
+
+    def __init__(self, breaker, rate_limiter=None, **kwargs):
+        super().__init__(**kwargs)
+        self.breaker = breaker
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        started_at = self.breaker.before_call()
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        try:
+            response = super().request(*args, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        if _is_upstream_failure(response.status_code):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success(started_at)
+        return response
@@ -1,30 +1,64 @@
+import hmac
 import json
 import logging
+import os
+from functools import wraps
 
-from flask import request
+from flask import jsonify, request
 
 from app import app
 
 from .methods import (
+    call_path_deadline,
     delete_twilio_worker_from_close_user_id,
     dial_redirected_phone_number,
     process_close_group_update,
     redirect_key_press_to_vm,
+    request_sync,
     send_call_to_queue,
     send_redirect_instruction_on_assignment_callback,
     setup_wait_url,
-    update_all_twilio_statuses_and_group_number_participants,
+    sync_within_deadline,
 )
+from .profiling import profiled
+from .profiling import settings as profiling_settings
+from .tenants import get_tenant
 
 # Format logging
-log_format = "[%(asctime)s] %(levelname)s %(message)s"
+log_format = "[%(asctime)s] %(levelname)s [%(tenant)s] %(message)s"
 logging.basicConfig(level=logging.INFO, format=log_format)
 
+
+def tenant_route(rule, **options):
+    """
+    Register a route for every tenant, at /<tenant_id>/<rule> and, for the
+    default tenant, at <rule>. The view runs on behalf of that tenant.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def tenant_view(tenant_id=None):
+            tenant = get_tenant(tenant_id)
+            if tenant is None:
+                return "Not found", 404
+            with tenant.activated():
+                return view()
+
+        app.add_url_rule(rule, view_func=tenant_view, **options)
+        app.add_url_rule(
+            '/<tenant_id>' + rule, view_func=tenant_view, **options
+        )
+        return tenant_view
+
+    return decorator
+
+
 #############
 # Close Routes
 #############
 
-@app.route('/deactivate-membership/', methods=['POST'])
+@tenant_route('/deactivate-membership/', methods=['POST'])
+@profiled('deactivate-membership')
 def delete_twilio_worker():
     """Delete a Twilio Worker when a Close membership is deactivated."""
     try:
@@ -43,14 +77,17 @@ def delete_twilio_worker():
         return str(e), 400
 
 
-@app.route('/close-completed-call/', methods=['POST'])
+@tenant_route('/close-completed-call/', methods=['POST'])
+@profiled('close-completed-call')
 def close_completed_call():
     """
     Update the Close status of all users when there is a completed call webhook.
-    We do this to keep the statuses of every user up to date.
+    We do this to keep the statuses of every user up to date. The sync runs in
+    the background, so a burst of webhooks never ties up the workers that
+    answer calls.
     """
     try:
-        update_all_twilio_statuses_and_group_number_participants()
+        request_sync(invalidate_close_availability=True)
         return "Webhook processed successfully", 200
     except Exception as e:
         logging.error(
@@ -59,7 +96,8 @@ def close_completed_call():
         return str(e), 400
 
 
-@app.route('/user-manager-group-updated/', methods=['POST'])
+@tenant_route('/user-manager-group-updated/', methods=['POST'])
+@profiled('user-manager-group-updated')
 def updated_group():
     """
     Process group updates in Close, since they may affect who's
@@ -88,16 +126,18 @@ def updated_group():
 #############
 
 
-@app.route('/incoming-call/', methods=['POST'])
+@tenant_route('/incoming-call/', methods=['POST'])
+@profiled('incoming-call')
 def create_task():
     """
     Accept incoming calls in Twilio and add them to the appropriate
-    Task Queue.
+    Task Queue, within the call path latency budget.
     """
     try:
-        update_all_twilio_statuses_and_group_number_participants()
+        deadline = call_path_deadline()
+        sync_within_deadline(deadline)
         if request.values.get('To'):
-            return send_call_to_queue(request), 200
+            return send_call_to_queue(request, deadline), 200
         return "Successfully sent a call to the queue", 200
     except Exception as e:
         logging.error(
@@ -106,7 +146,8 @@ def create_task():
         return str(e), 400
 
 
-@app.route('/assignment-callback/', methods=['POST'])
+@tenant_route('/assignment-callback/', methods=['POST'])
+@profiled('assignment-callback')
 def assignment_callback():
     """
     Rings the correct Close group number based on the that the call goes
@@ -130,7 +171,8 @@ def assignment_callback():
         return str(e), 400
 
 
-@app.route('/redirect-task/', methods=['POST'])
+@tenant_route('/redirect-task/', methods=['POST'])
+@profiled('redirect-task')
 def redirect_task():
     """
     Redirect a task to a group number when there is an available user. We have
@@ -139,7 +181,10 @@ def redirect_task():
     a call into Close.
     """
     try:
-        return dial_redirected_phone_number(request), 200
+        return (
+            dial_redirected_phone_number(request, call_path_deadline()),
+            200,
+        )
     except Exception as e:
         logging.error(
             f"Failed when redirecting a queued activity to a phone number because {str(e)}"
@@ -147,7 +192,8 @@ def redirect_task():
         return str(e), 400
 
 
-@app.route('/wait-url/', methods=['POST'])
+@tenant_route('/wait-url/', methods=['POST'])
+@profiled('wait-url')
 def wait_url():
     """
     Setup the wait-url to play the wait music and ask the user for an input
@@ -160,7 +206,8 @@ def wait_url():
         return str(e), 400
 
 
-@app.route('/forward-to-vm/', methods=['POST'])
+@tenant_route('/forward-to-vm/', methods=['POST'])
+@profiled('forward-to-vm')
 def forward_to_vm():
     """
     Forward the caller into a voicemail box in Close, if they decide they want
@@ -173,3 +220,41 @@ def forward_to_vm():
             f"Failed when redirecting a queued task after a key press to escape because {str(e)}"
         )
         return str(e), 400
+
+
+#############
+# Admin Routes
+#############
+
+
+def _is_admin_request():
+    """Whether the request carries the ADMIN_TOKEN as a bearer token."""
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        return False
+    # compare_digest only takes ASCII strings, so compare the bytes.
+    return hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(),
+        f'Bearer {admin_token}'.encode(),
+    )
+
+
+@app.route('/admin/profiling/', methods=['GET', 'POST'])
+def profiling():
+    """
+    View or change the profiling settings (sample_rate, mode, interval_ms).
+    Changes reach every worker process on the dyno within a second. Set
+    PROFILE_SAMPLE_RATE to turn profiling on for every dyno instead.
+    """
+    if not _is_admin_request():
+        return "Not found", 404
+    try:
+        if request.method == 'POST':
+            profiling_settings.update(**json.loads(request.data or '{}'))
+            logging.info(
+                f"Profiling settings changed to {profiling_settings.as_dict()}"
+            )
+        return jsonify(profiling_settings.as_dict()), 200
+    except Exception as e:
+        logging.error(f"Failed to update profiling settings because {str(e)}")
+        return str(e), 400
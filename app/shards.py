@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+import time
+import zlib
+
+# Each gunicorn worker process owns a shard of the tenants, set by the hooks
+# in gunicorn.conf.py. Only the owner of a tenant syncs it and tails its
+# change feed; every process can answer its calls. Without the hooks there is
+# one shard and every process owns every tenant.
+shard_index = int(os.environ.get('SHARD_INDEX', 0))
+shard_count = int(os.environ.get('SHARD_COUNT', 1))
+
+# Where processes leave each other sync requests and routing state. It must be
+# shared by every worker process, so a local directory is enough.
+state_dir = os.environ.get('SHARD_STATE_DIR', '/tmp/close-twilio-taskrouter')
+poll_interval = float(os.environ.get('SHARD_POLL_SECONDS', 0.1))
+
+# What a process can ask the owner of a tenant to do before it syncs.
+SYNC = 'sync'
+INVALIDATE_CLOSE_AVAILABILITY = 'invalidate-close-availability'
+CHECK_MEMBERSHIPS = 'check-memberships'
+_REQUEST_KINDS = (INVALIDATE_CLOSE_AVAILABILITY, CHECK_MEMBERSHIPS)
+
+
+def is_sharded():
+    return shard_count > 1
+
+
+def owns(tenant_id):
+    """Whether this process syncs the given tenant."""
+    if not is_sharded():
+        return True
+    return zlib.crc32(tenant_id.encode()) % shard_count == shard_index
+
+
+def routing_state_path(tenant_id):
+    """
+    Where the owner of a tenant shares its routing state with the other
+    processes, or None when this process owns every tenant.
+    """
+    if not is_sharded():
+        return None
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, f'{tenant_id}.routing.json')
+
+
+def _request_path(tenant_id, kind):
+    return os.path.join(state_dir, f'{tenant_id}.{kind}.request')
+
+
+def request(tenant_id, *kinds):
+    """
+    Ask the process that owns a tenant to sync it. Requests are coalesced:
+    however many arrive before the owner looks, it syncs once.
+
+    Args:
+        tenant_id (str): The tenant to sync.
+        kinds (str): What else to do before syncing, e.g.
+            INVALIDATE_CLOSE_AVAILABILITY.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    # The sync request is written last, so the owner never takes it without
+    # the others that came with it.
+    for kind in [i for i in _REQUEST_KINDS if i in kinds] + [SYNC]:
+        with open(_request_path(tenant_id, kind), 'a'):
+            pass
+
+
+def _take_requests(tenant_id):
+    """Remove and return the kinds of request waiting for a tenant."""
+    try:
+        os.remove(_request_path(tenant_id, SYNC))
+    except FileNotFoundError:
+        return set()
+    taken = {SYNC}
+    for kind in _REQUEST_KINDS:
+        try:
+            os.remove(_request_path(tenant_id, kind))
+            taken.add(kind)
+        except FileNotFoundError:
+            pass
+    return taken
+
+
+def watch(tenant_ids, on_request):
+    """
+    Call `on_request(tenant_id, kinds)` from a background thread whenever
+    another process asks for one of these tenants to be synced.
+    """
+
+    def run():
+        while True:
+            time.sleep(poll_interval)
+            for tenant_id in tenant_ids:
+                try:
+                    kinds = _take_requests(tenant_id)
+                    if kinds:
+                        on_request(tenant_id, kinds)
+                except Exception as e:
+                    logging.error(
+                        f'Failed to take sync requests for {tenant_id} because {str(e)}'
+                    )
+
+    thread = threading.Thread(target=run, name='shard-watcher', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from enum import Enum
+
+# Canonical frozensets of group IDs. Most workers share one of a handful of
+# group combinations, so every worker with the same groups points at the same
+# frozenset instead of carrying its own copy.
+_canonical_group_sets = {}
+
+
+class Activity(Enum):
+    """
+    A user's availability, shared by Close and Twilio. The values are the
+    status names used in the twilio_status_mapping config.
+    """
+
+    OFFLINE = 'offline'
+    ONLINE = 'online'
+    ON_CALL = 'on_call'
+    # Anything else, e.g. a TaskRouter activity this app doesn't manage.
+    UNKNOWN = 'unknown'
+
+    @classmethod
+    def from_name(cls, name):
+        try:
+            return cls(name)
+        except ValueError:
+            return cls.UNKNOWN
+
+
+def save_json(path, data):
+    """
+    Write `data` to `path` as JSON. The file is written then renamed into
+    place, so a crash or another process never sees a half-written file.
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def intern_id(value):
+    """Intern a Close or Twilio ID so repeated syncs share one string."""
+    return sys.intern(value) if value else value
+
+
+def intern_groups(groups):
+    """
+    Return the canonical frozenset for an iterable of group IDs.
+
+    Args:
+        groups (iterable): Group IDs.
+
+    Returns:
+        frozenset: Interned group IDs, shared with every other caller asking
+        for the same set.
+    """
+    group_set = frozenset(intern_id(i) for i in groups)
+    return _canonical_group_sets.setdefault(group_set, group_set)
+
+
+class WorkerState:
+    """
+    The parts of a Twilio Worker that we sync from Close.
+
+    Attributes:
+        sid (str): The Worker SID.
+        friendly_name (str): The name of the Worker.
+        activity (Activity): The Worker's current activity in Twilio.
+        close_user_id (str): The Close User ID of the Worker, or None if the
+            Worker isn't managed by this app.
+        groups (frozenset): The Close groups in the Worker's attributes, or
+            None if the attribute has never been written.
+    """
+
+    __slots__ = ('sid', 'friendly_name', 'activity', 'close_user_id', 'groups')
+
+    def __init__(self, sid, friendly_name, activity, close_user_id, groups):
+        self.sid = sid
+        self.friendly_name = friendly_name
+        self.activity = activity
+        self.close_user_id = close_user_id
+        self.groups = groups
+
+    @classmethod
+    def from_twilio(cls, worker):
+        """Build a WorkerState from a TaskRouter WorkerInstance."""
+        attributes = json.loads(worker.attributes)
+        close_user_id = attributes.get('close_user_id')
+        groups = attributes.get('groups') if close_user_id else None
+        return cls(
+            sid=intern_id(worker.sid),
+            friendly_name=worker.friendly_name,
+            activity=Activity.from_name(worker.activity_name),
+            close_user_id=intern_id(close_user_id),
+            groups=intern_groups(groups) if groups is not None else None,
+        )
+
+    def __repr__(self):
+        return f'<WorkerState {self.sid} {self.close_user_id} {self.activity.name}>'
+
+
+class RoutingState:
+    """
+    The last known good view of which Close groups have an agent available,
+    recorded by every complete sync. Caller-facing routes fall back to it when
+    TaskRouter can't be read in time.
+
+    With a `path`, the state is also written to that file by the process that
+    syncs the tenant and read from it by every other process.
+    """
+
+    __slots__ = ('_snapshot', 'path', '_loaded_mtime')
+
+    def __init__(self, path=None):
+        # (frozenset of online group IDs, time.time() of the sync)
+        self._snapshot = None
+        self.path = path
+        self._loaded_mtime = None
+
+    def update(self, online_groups):
+        self._snapshot = (frozenset(online_groups), time.time())
+        if self.path:
+            self._save(self._snapshot)
+
+    def updated_at(self):
+        """The time.time() of the last sync, or None if there hasn't been one."""
+        snapshot = self._load()
+        return snapshot[1] if snapshot else None
+
+    def has_online_users(self, group_id, max_age=None):
+        """
+        Args:
+            group_id (str): A Close user manager group ID.
+            max_age (float): Ignore a snapshot older than this many seconds.
+
+        Returns:
+            bool: Whether the group had an agent available at the last sync,
+            or None if there is no (fresh enough) snapshot.
+        """
+        snapshot = self._load()
+        if snapshot is None:
+            return None
+        online_groups, updated_at = snapshot
+        if max_age is not None and time.time() - updated_at > max_age:
+            return None
+        return group_id in online_groups
+
+    def _load(self):
+        """The newest snapshot, reading the file if another process wrote it."""
+        if not self.path:
+            return self._snapshot
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._loaded_mtime:
+                with open(self.path) as f:
+                    saved = json.load(f)
+                self._snapshot = (
+                    intern_groups(saved['online_groups']),
+                    saved['updated_at'],
+                )
+                self._loaded_mtime = mtime
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(
+                f'Using the routing state in memory because {self.path} could not be read because {str(e)}'
+            )
+        return self._snapshot
+
+    def _save(self, snapshot):
+        online_groups, updated_at = snapshot
+        try:
+            save_json(
+                self.path,
+                {
+                    'online_groups': sorted(online_groups),
+                    'updated_at': updated_at,
+                },
+            )
+            self._loaded_mtime = os.stat(self.path).st_mtime_ns
+        except Exception as e:
+            logging.error(
+                f'Failed to share the routing state in {self.path} because {str(e)}'
+            )
+
+
+class ParticipantCache:
+    """
+    A write-through cache of each Close group number's participants.
+
+    This app is the only writer of group number participants, so after we read
+    or write them we know what they are without asking Close again. Entries are
+    re-read from Close once `verify_after` seconds have passed since the last
+    read, to catch anyone changing them by hand and writes made by other
+    processes, which keep caches of their own. With a `verify_after` of 0
+    nothing is cached.
+    """
+
+    def __init__(self, verify_after):
+        self.verify_after = verify_after
+        self._lock = threading.Lock()
+        # phone_number_id -> (frozenset of user IDs, time.monotonic() of the
+        # last read from Close)
+        self._entries = {}
+
+    def get(self, phone_number_id):
+        """The cached participants, or None if they need to be read."""
+        with self._lock:
+            entry = self._entries.get(phone_number_id)
+        if entry is None:
+            return None
+        participants, verified_at = entry
+        if time.monotonic() - verified_at >= self.verify_after:
+            return None
+        return participants
+
+    def verified(self, phone_number_id, participants):
+        """Record participants just read from Close."""
+        with self._lock:
+            self._entries[phone_number_id] = (
+                frozenset(participants),
+                time.monotonic(),
+            )
+
+    def written(self, phone_number_id, participants):
+        """Record participants just written to Close."""
+        with self._lock:
+            entry = self._entries.get(phone_number_id)
+            verified_at = entry[1] if entry else time.monotonic()
+            self._entries[phone_number_id] = (
+                frozenset(participants),
+                verified_at,
+            )
+
+    def invalidate(self, phone_number_id):
+        with self._lock:
+            self._entries.pop(phone_number_id, None)
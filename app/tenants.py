@@ -0,0 +1,284 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from twilio.rest import Client
+
+from . import shards
+from .resilience import (
+    BreakerTwilioHttpClient,
+    CircuitBreaker,
+    CloseClient,
+    RateLimiter,
+)
+from .state import ParticipantCache, RoutingState
+
+SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
+
+# Routes without a tenant ID in their path belong to the tenant with this ID,
+# or to the only tenant if there is just one.
+DEFAULT_TENANT_ID = 'default'
+
+# Tenant IDs appear in route paths and file names.
+_TENANT_ID_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]*$')
+
+# Every upstream request is capped at UPSTREAM_TIMEOUT_SECONDS, and each
+# tenant's upstreams get their own circuit breakers so that a degraded vendor
+# account fails fast instead of piling up requests.
+upstream_timeout_seconds = float(
+    os.environ.get('UPSTREAM_TIMEOUT_SECONDS', 10)
+)
+circuit_breaker_failures = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 5))
+circuit_breaker_reset_seconds = float(
+    os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', 30)
+)
+# Cached Close group number participants are re-read from Close every
+# PARTICIPANT_CACHE_VERIFY_SECONDS. Each process has its own cache, so while
+# more than one process writes a tenant's group numbers (more than one dyno,
+# or gunicorn without gunicorn.conf.py), a write another process made can go
+# unseen for this long. 0 turns the cache off.
+participant_cache_verify_seconds = float(
+    os.environ.get('PARTICIPANT_CACHE_VERIFY_SECONDS', 15)
+)
+# The size of each tenant's thread pools. Tenants never share threads, so one
+# tenant's slow upstream can't hold up another tenant's calls.
+call_path_threads = int(os.environ.get('CALL_PATH_THREADS', 8))
+group_number_update_threads = int(
+    os.environ.get('GROUP_NUMBER_UPDATE_THREADS', 8)
+)
+# Requests a second each tenant may make to Close and to Twilio from each
+# process, unless the tenant sets its own. Every worker process and dyno has
+# its own limiters, so with WEB_CONCURRENCY=N a tenant can make up to N times
+# as many requests in all. 0 means no limit.
+close_requests_per_second_per_process = float(
+    os.environ.get('CLOSE_REQUESTS_PER_SECOND_PER_PROCESS', 0)
+)
+twilio_requests_per_second_per_process = float(
+    os.environ.get('TWILIO_REQUESTS_PER_SECOND_PER_PROCESS', 0)
+)
+
+# The tenant the current request or sync is working for.
+_current_tenant = contextvars.ContextVar('tenant')
+
+
+class Tenant:
+    """
+    One Close organization and TaskRouter workspace served by this app.
+
+    Everything a tenant's calls and syncs touch belongs to it alone: its
+    config, API clients, circuit breakers, rate limits, caches and thread
+    pools. Its credentials are read from the usual environment variables with
+    `env_prefix` in front, e.g. BRAND_A_CLOSE_API_KEY.
+
+    Attributes:
+        id (str): Identifies the tenant in route paths, e.g.
+            /brand-a/incoming-call/.
+        config (dict): The tenant's queue mappings, status mappings, hold
+            music and fallback number, as in static/config.json.
+        org_id (str): The Close organization ID, or None until it has been
+            looked up.
+        change_feed (ChangeFeed): The tenant's Close change feed, or None if
+            it's off or hasn't been set up yet.
+        change_feed_path (str): Where the change feed is saved, or None if
+            it's off.
+        cached_close_availability (tuple): (user_id to Activity map,
+            time.monotonic() it was fetched), or None.
+        check_memberships (bool): Whether the next sync should make sure every
+            membership has a Twilio Worker first.
+    """
+
+    def __init__(
+        self,
+        tenant_id,
+        env_prefix='',
+        config='config.json',
+        close_requests_per_second_per_process=None,
+        twilio_requests_per_second_per_process=None,
+    ):
+        if not _TENANT_ID_PATTERN.match(tenant_id):
+            raise ValueError(
+                f'Tenant ID {tenant_id!r} must be lowercase letters, digits, - and _'
+            )
+        self.id = tenant_id
+        with open(os.path.join(SITE_ROOT, 'static', config)) as f:
+            self.config = json.load(f)
+
+        def env(name):
+            return os.environ.get(env_prefix + name)
+
+        self.close_api_key = env('CLOSE_API_KEY')
+        self.close_breaker = CircuitBreaker(
+            f'{tenant_id} close',
+            failure_threshold=circuit_breaker_failures,
+            reset_timeout=circuit_breaker_reset_seconds,
+        )
+        self.api = CloseClient(
+            self.close_api_key,
+            self.close_breaker,
+            timeout=upstream_timeout_seconds,
+            rate_limiter=_rate_limiter(
+                close_requests_per_second_per_process
+            ),
+        )
+        # Point the client somewhere other than api.close.com (e.g. the fake
+        # Close server used by the load test harness).
+        if env('CLOSE_API_BASE_URL'):
+            self.api.base_url = env('CLOSE_API_BASE_URL')
+        self.org_id = None
+
+        self.twilio_breaker = CircuitBreaker(
+            f'{tenant_id} twilio',
+            failure_threshold=circuit_breaker_failures,
+            reset_timeout=circuit_breaker_reset_seconds,
+        )
+        self.twilio_client = Client(
+            env('TWILIO_ACCOUNT_SID'),
+            env('TWILIO_AUTH_TOKEN'),
+            http_client=BreakerTwilioHttpClient(
+                self.twilio_breaker,
+                rate_limiter=_rate_limiter(
+                    twilio_requests_per_second_per_process
+                ),
+                timeout=upstream_timeout_seconds,
+            ),
+        )
+        # Point TaskRouter requests somewhere other than taskrouter.twilio.com
+        # (e.g. the fake TaskRouter server used by the load test harness).
+        if env('TWILIO_TASKROUTER_BASE_URL'):
+            self.twilio_client.taskrouter.base_url = env(
+                'TWILIO_TASKROUTER_BASE_URL'
+            )
+        self.workspace_sid = env('TWILIO_WORKSPACE_SID')
+        self.workflow_sid = env('TWILIO_WORKFLOW_SID')
+
+        self.routing_state = RoutingState(shards.routing_state_path(tenant_id))
+        self.participant_cache = ParticipantCache(
+            verify_after=participant_cache_verify_seconds
+        )
+        self.change_feed = None
+        self.change_feed_path = env('CHANGE_FEED_STATE_PATH')
+        self.cached_close_availability = None
+        self.check_memberships = False
+
+        self.call_executor = ThreadPoolExecutor(
+            max_workers=call_path_threads,
+            thread_name_prefix=f'{tenant_id}-call',
+        )
+        self.group_number_executor = ThreadPoolExecutor(
+            max_workers=group_number_update_threads,
+            thread_name_prefix=f'{tenant_id}-group-number',
+        )
+        # Syncs run one at a time, so a burst of them queues up here instead
+        # of taking threads from anything else.
+        self.sync_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'{tenant_id}-sync'
+        )
+        self.sync_lock = threading.Lock()
+        self.sync_in_flight = None
+
+    @property
+    def owned(self):
+        """Whether this process syncs the tenant."""
+        return shards.owns(self.id)
+
+    def workspace(self):
+        """The tenant's TaskRouter workspace."""
+        return self.twilio_client.taskrouter.workspaces(self.workspace_sid)
+
+    def url_path(self, path):
+        """The path of one of this tenant's routes, e.g. '/wait-url/'."""
+        if get_tenant() is self:
+            return path
+        return f'/{self.id}{path}'
+
+    @contextmanager
+    def activated(self):
+        """Work on behalf of this tenant for the duration of the block."""
+        token = _current_tenant.set(self)
+        try:
+            yield self
+        finally:
+            _current_tenant.reset(token)
+
+    def __repr__(self):
+        return f'<Tenant {self.id}>'
+
+
+def _rate_limiter(requests_per_second):
+    requests_per_second = float(requests_per_second or 0)
+    return (
+        RateLimiter(requests_per_second) if requests_per_second > 0 else None
+    )
+
+
+def _load_tenants():
+    """
+    Load the tenants listed in the TENANTS_CONFIG file, e.g.
+
+        {"tenants": [{"id": "brand-a", "env_prefix": "BRAND_A_",
+                      "config": "brand-a.json",
+                      "close_requests_per_second_per_process": 10}]}
+
+    Without TENANTS_CONFIG there is a single default tenant, configured by
+    the unprefixed environment variables and static/config.json.
+
+    Returns:
+        dict: Tenant ID to Tenant.
+    """
+    entries = [{'id': DEFAULT_TENANT_ID}]
+    if os.environ.get('TENANTS_CONFIG'):
+        with open(os.environ.get('TENANTS_CONFIG')) as f:
+            entries = json.load(f)['tenants']
+    tenants = {}
+    for entry in entries:
+        entry = dict(entry)
+        tenant_id = entry.pop('id')
+        if tenant_id in tenants:
+            raise ValueError(f'Tenant {tenant_id} is configured twice')
+        entry.setdefault(
+            'close_requests_per_second_per_process',
+            close_requests_per_second_per_process,
+        )
+        entry.setdefault(
+            'twilio_requests_per_second_per_process',
+            twilio_requests_per_second_per_process,
+        )
+        tenants[tenant_id] = Tenant(tenant_id, **entry)
+    return tenants
+
+
+tenants = _load_tenants()
+
+
+def get_tenant(tenant_id=None):
+    """
+    Args:
+        tenant_id (str): A tenant ID, or None for the default tenant.
+
+    Returns:
+        Tenant: The tenant, or None if there is no such tenant.
+    """
+    if tenant_id is None:
+        if len(tenants) == 1:
+            return next(iter(tenants.values()))
+        return tenants.get(DEFAULT_TENANT_ID)
+    return tenants.get(tenant_id)
+
+
+def current_tenant():
+    """The tenant the current request or sync is working for."""
+    return _current_tenant.get()
+
+
+class TenantLogFilter(logging.Filter):
+    """Adds the ID of the current tenant to log records as %(tenant)s."""
+
+    def filter(self, record):
+        tenant = _current_tenant.get(None)
+        record.tenant = tenant.id if tenant else '-'
+        return True
@@ -0,0 +1,17 @@
+import itertools
+import os
+
+
+def pre_fork(server, worker):
+    """
+    Give each new worker the lowest shard index that no live worker holds, so
+    a worker that is replaced hands its tenants to its replacement.
+    """
+    taken = {getattr(i, 'shard_index', None) for i in server.WORKERS.values()}
+    worker.shard_index = next(i for i in itertools.count() if i not in taken)
+
+
+def post_fork(server, worker):
+    """Tell the app which shard of the tenants this worker owns."""
+    os.environ['SHARD_INDEX'] = str(worker.shard_index)
+    os.environ['SHARD_COUNT'] = str(server.num_workers)
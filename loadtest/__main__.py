@@ -0,0 +1,499 @@
+"""
+Call-storm load generator.
+
+Starts fake Close and TaskRouter servers with injected latency, boots the real
+app under gunicorn against them, and replays call lifecycles across an
+increasing number of concurrent callers:
+
+    incoming-call -> wait-url polls -> assignment-callback -> redirect-task
+    -> close-completed-call
+
+Per route latency percentiles and error rates are reported for each
+concurrency level, along with the first level where /incoming-call/ breaks the
+latency SLO (Twilio gives up on a webhook after 15 seconds) or the error budget.
+
+    python -m loadtest --concurrency 1,10,25,50 --calls 200 \
+        --close-latency 0.15 --twilio-latency 0.1 --workers 2
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .fakes import (
+    ACCOUNT_SID,
+    WORKFLOW_SID,
+    WORKSPACE_SID,
+    FakeCloseHandler,
+    FakeOrg,
+    FakeServer,
+    FakeTaskRouterHandler,
+)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(REPO_ROOT, 'app', 'static', 'config.json')
+ROUTES = [
+    '/incoming-call/',
+    '/wait-url/',
+    '/assignment-callback/',
+    '/redirect-task/',
+    '/close-completed-call/',
+]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct * len(sorted_values) / 100.0), 1)
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Thread-safe collection of (route, latency, ok) samples."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, route, latency, ok):
+        with self.lock:
+            self.latencies[route].append(latency)
+            if not ok:
+                self.errors[route] += 1
+
+    def summary(self):
+        rows = {}
+        for route in ROUTES:
+            values = sorted(self.latencies.get(route, []))
+            if not values:
+                continue
+            rows[route] = {
+                'count': len(values),
+                'errors': self.errors[route],
+                'error_rate': self.errors[route] / len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': values[-1],
+            }
+        return rows
+
+
+class Caller:
+    """Replays a single call lifecycle against the app."""
+
+    def __init__(self, target, queue, recorder, args, tenant_id=None):
+        self.target = target.rstrip('/')
+        if tenant_id:
+            self.target += '/' + tenant_id
+        self.queue = queue
+        self.recorder = recorder
+        self.args = args
+        self.call_sid = 'CA' + uuid.uuid4().hex
+        self.task_sid = 'WT' + uuid.uuid4().hex
+
+    def _post(self, route, form=None, body=None, query=None):
+        url = self.target + route
+        if query:
+            url += '?' + urlencode(query)
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers = {'Content-Type': 'application/json'}
+        else:
+            data = urlencode(form or {}).encode()
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        start = time.perf_counter()
+        try:
+            with urlopen(
+                Request(url, data=data, headers=headers),
+                timeout=self.args.timeout,
+            ) as resp:
+                resp.read()
+                ok = resp.status < 400
+        except HTTPError as e:
+            ok = e.code < 400
+        except (URLError, socket.timeout, ConnectionError):
+            ok = False
+        self.recorder.record(route, time.perf_counter() - start, ok)
+
+    def run(self):
+        call = {
+            'CallSid': self.call_sid,
+            'AccountSid': ACCOUNT_SID,
+            'To': self.queue['twilio_number'],
+            'From': '+1555%07d' % random.randint(0, 9999999),
+        }
+        self._post('/incoming-call/', form=call)
+        for _ in range(self.args.wait_polls):
+            time.sleep(self.args.wait_interval)
+            self._post('/wait-url/', form=call)
+        self._post(
+            '/assignment-callback/',
+            form={
+                'TaskSid': self.task_sid,
+                'WorkspaceSid': WORKSPACE_SID,
+                'TaskAttributes': json.dumps(
+                    {'to_number': call['To'], 'call_sid': self.call_sid}
+                ),
+            },
+        )
+        self._post(
+            '/redirect-task/',
+            form=call,
+            query={
+                'task_id': self.task_sid,
+                'phone_number': self.queue['close_group_number'],
+            },
+        )
+        self._post(
+            '/close-completed-call/',
+            body={
+                'event': {
+                    'object_type': 'activity.call',
+                    'action': 'completed',
+                    'data': {'status': 'completed'},
+                }
+            },
+        )
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _tenant_id(index):
+    return f'tenant-{index}'
+
+
+def start_gunicorn(args, close_server, taskrouter_server):
+    """Boot the real app under gunicorn against the fake servers."""
+    port = _free_port()
+    target = f'http://127.0.0.1:{port}/'
+    env = dict(
+        os.environ,
+        CLOSE_API_KEY='api_loadtest',
+        CLOSE_API_BASE_URL=close_server.url + '/api/v1/',
+        TWILIO_ACCOUNT_SID=ACCOUNT_SID,
+        TWILIO_AUTH_TOKEN='loadtest',
+        TWILIO_TASKROUTER_BASE_URL=taskrouter_server.url,
+        TWILIO_WORKSPACE_SID=WORKSPACE_SID,
+        TWILIO_WORKFLOW_SID=WORKFLOW_SID,
+        BASE_URL=target,
+    )
+    state_dir = tempfile.mkdtemp(prefix='loadtest-')
+    env['SHARD_STATE_DIR'] = os.path.join(state_dir, 'shards')
+    if args.change_feed:
+        env['CHANGE_FEED_STATE_PATH'] = os.path.join(
+            state_dir, 'change-feed.json'
+        )
+    if args.tenants > 1:
+        # Every tenant is the same fake org and workspace, but each one gets
+        # its own state, thread pools and shard, as separate brands would.
+        env['TENANTS_CONFIG'] = os.path.join(state_dir, 'tenants.json')
+        with open(env['TENANTS_CONFIG'], 'w') as f:
+            json.dump(
+                {
+                    'tenants': [
+                        {'id': _tenant_id(i)} for i in range(args.tenants)
+                    ]
+                },
+                f,
+            )
+    command = [
+        sys.executable,
+        '-c',
+        'from gunicorn.app.wsgiapp import run; run()',
+        'app:app',
+        '--config',
+        'gunicorn.conf.py',
+        '--bind',
+        f'127.0.0.1:{port}',
+        '--workers',
+        str(args.workers),
+        '--threads',
+        str(args.threads),
+        '--timeout',
+        str(int(args.timeout * 4)),
+    ]
+    log = (
+        open(args.gunicorn_log, 'ab')
+        if args.gunicorn_log
+        else subprocess.DEVNULL
+    )
+    process = subprocess.Popen(
+        command, cwd=REPO_ROOT, env=env, stdout=log, stderr=log
+    )
+
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f'gunicorn exited with {process.returncode} during startup'
+            )
+        try:
+            urlopen(target, timeout=1).read()
+            return process, target
+        except HTTPError:
+            return process, target
+        except (URLError, socket.timeout, ConnectionError):
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def churn(org, rate, stop):
+    """Flip agent availability `rate` times a second until stopped."""
+    while rate > 0 and not stop.wait(1.0 / rate):
+        org.churn()
+
+
+def run_level(target, queues, concurrency, args):
+    """Run `args.calls` call lifecycles with `concurrency` callers at once."""
+    recorder = Recorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(args.calls):
+            caller = Caller(
+                target,
+                random.choice(queues),
+                recorder,
+                args,
+                tenant_id=_tenant_id(i % args.tenants)
+                if args.tenants > 1
+                else None,
+            )
+            pool.submit(caller.run)
+    return recorder.summary(), time.perf_counter() - start
+
+
+def _ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def print_level(concurrency, rows, elapsed, calls):
+    print(
+        f'\n== {concurrency} concurrent callers: {calls} calls in {elapsed:.1f}s '
+        f'({calls / elapsed:.1f} calls/s)'
+    )
+    print(
+        f"{'route':<24}{'count':>7}{'errors':>8}{'err%':>7}"
+        f"{'p50ms':>8}{'p90ms':>8}{'p99ms':>8}{'maxms':>8}"
+    )
+    for route, row in rows.items():
+        print(
+            f"{route:<24}{row['count']:>7}{row['errors']:>8}"
+            f"{row['error_rate'] * 100:>6.1f}%{_ms(row['p50']):>8}"
+            f"{_ms(row['p90']):>8}{_ms(row['p99']):>8}{_ms(row['max']):>8}"
+        )
+
+
+def is_saturated(rows, args):
+    """Whether the caller-facing route broke the SLO or the error budget."""
+    incoming = rows.get('/incoming-call/')
+    if not incoming:
+        return False
+    total = sum(i['count'] for i in rows.values())
+    errors = sum(i['errors'] for i in rows.values())
+    return incoming['p99'] > args.slo or errors / total > args.max_error_rate
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m loadtest', description=__doc__.split('\n\n')[0]
+    )
+    parser.add_argument(
+        '--target',
+        help='Use an already running app instead of booting gunicorn. The app must be pointed at fakes started elsewhere.',
+    )
+    parser.add_argument(
+        '--concurrency',
+        default='1,5,10,25,50',
+        help='Comma separated concurrent caller levels to step through.',
+    )
+    parser.add_argument(
+        '--calls',
+        type=int,
+        default=100,
+        help='Call lifecycles to replay per level.',
+    )
+    parser.add_argument(
+        '--users',
+        type=int,
+        default=200,
+        help='Close users (and Twilio Workers) in the fake org.',
+    )
+    parser.add_argument('--online-ratio', type=float, default=0.5)
+    parser.add_argument(
+        '--churn-rate',
+        type=float,
+        default=2.0,
+        help='Availability changes per second in the fake org.',
+    )
+    parser.add_argument(
+        '--close-latency',
+        type=float,
+        default=0.1,
+        help='Seconds added to every fake Close response.',
+    )
+    parser.add_argument(
+        '--twilio-latency',
+        type=float,
+        default=0.1,
+        help='Seconds added to every fake TaskRouter response.',
+    )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0.05,
+        help='Extra uniform random latency in seconds.',
+    )
+    parser.add_argument('--wait-polls', type=int, default=3)
+    parser.add_argument('--wait-interval', type=float, default=0.5)
+    parser.add_argument(
+        '--workers', type=int, default=1, help='gunicorn worker processes.'
+    )
+    parser.add_argument(
+        '--threads', type=int, default=1, help='gunicorn threads per worker.'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=15.0,
+        help='Client timeout per request; Twilio abandons webhooks after 15s.',
+    )
+    parser.add_argument(
+        '--slo',
+        type=float,
+        default=10.0,
+        help='p99 seconds for /incoming-call/ before a level counts as saturated.',
+    )
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    parser.add_argument(
+        '--change-feed',
+        action='store_true',
+        help='Run the app with the Close change feed on.',
+    )
+    parser.add_argument(
+        '--tenants',
+        type=int,
+        default=1,
+        help='Serve this many tenants from the one deployment, spreading calls across them.',
+    )
+    parser.add_argument(
+        '--gunicorn-log', help='File to append gunicorn output to.'
+    )
+    parser.add_argument(
+        '--json',
+        dest='json_path',
+        help='Also write the results to this file as JSON.',
+    )
+    parser.add_argument('--seed', type=int)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+
+    org = FakeOrg(config, args.users, args.online_ratio, seed=args.seed)
+    close_server = FakeServer(
+        FakeCloseHandler, org, args.close_latency, args.jitter, args.seed
+    ).start()
+    taskrouter_server = FakeServer(
+        FakeTaskRouterHandler, org, args.twilio_latency, args.jitter, args.seed
+    ).start()
+
+    process = None
+    target = args.target
+    if not target:
+        print(
+            'Starting gunicorn against the fake Close and TaskRouter servers...'
+        )
+        process, target = start_gunicorn(args, close_server, taskrouter_server)
+
+    stop = threading.Event()
+    threading.Thread(
+        target=churn, args=(org, args.churn_rate, stop), daemon=True
+    ).start()
+
+    results = []
+    saturation = None
+    try:
+        for concurrency in [int(i) for i in args.concurrency.split(',')]:
+            close_before = close_server.request_count
+            twilio_before = taskrouter_server.request_count
+            rows, elapsed = run_level(
+                target, config['queue_mappings'], concurrency, args
+            )
+            print_level(concurrency, rows, elapsed, args.calls)
+            upstream = {
+                'close_requests': close_server.request_count - close_before,
+                'twilio_requests': taskrouter_server.request_count
+                - twilio_before,
+            }
+            print(
+                f"upstream requests: close={upstream['close_requests']} "
+                f"taskrouter={upstream['twilio_requests']}"
+            )
+            results.append(
+                {
+                    'concurrency': concurrency,
+                    'elapsed': elapsed,
+                    'routes': rows,
+                    'upstream': upstream,
+                }
+            )
+            if saturation is None and is_saturated(rows, args):
+                saturation = concurrency
+    finally:
+        stop.set()
+        if process:
+            process.terminate()
+            process.wait()
+        close_server.shutdown()
+        taskrouter_server.shutdown()
+
+    if saturation is None:
+        print('\nNo saturation point reached at the levels tested.')
+    else:
+        print(
+            f'\nSaturation point: {saturation} concurrent callers '
+            f'(/incoming-call/ p99 > {args.slo}s or error rate > '
+            f'{args.max_error_rate * 100:.1f}%).'
+        )
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(
+                {
+                    'args': vars(args),
+                    'levels': results,
+                    'saturation_concurrency': saturation,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+ORGANIZATION_ID = 'orga_loadtest'
+ACCOUNT_SID = 'AC' + '0' * 32
+WORKSPACE_SID = 'WS' + '0' * 32
+WORKFLOW_SID = 'WW' + '0' * 32
+
+
+class FakeOrg:
+    """
+    The shared state behind the fake Close and TaskRouter servers.
+
+    Users are spread round robin across the user manager groups in
+    config.json, and each one starts with a Twilio Worker so the app's startup
+    sync has real work to diff instead of creating every worker from scratch.
+    """
+
+    def __init__(self, config, num_users, online_ratio=0.5, seed=None):
+        self.lock = threading.Lock()
+        self.config = config
+        self.random = random.Random(seed)
+        self.activity_sid_to_name = {
+            v: k for k, v in config['twilio_status_mapping'].items()
+        }
+        groups = [
+            i['close_user_manager_group_id'] for i in config['queue_mappings']
+        ]
+
+        self.users = {}
+        self.availability = {}
+        self.group_members = {group: [] for group in groups}
+        self.workers = {}
+        for i in range(num_users):
+            user_id = f'user_{i:06d}'
+            self.users[user_id] = f'Load Test User {i}'
+            self.availability[user_id] = (
+                'online' if self.random.random() < online_ratio else 'offline'
+            )
+            if groups:
+                self.group_members[groups[i % len(groups)]].append(user_id)
+            self._add_worker(user_id, self.users[user_id], [])
+
+        self.participants = {
+            i['close_group_number_id']: [] for i in config['queue_mappings']
+        }
+        self.completed_tasks = set()
+        # Close event log entries, oldest first.
+        self.events = []
+
+    def _add_worker(self, close_user_id, friendly_name, groups):
+        sid = 'WK' + uuid.uuid4().hex
+        self.workers[sid] = {
+            'sid': sid,
+            'friendly_name': friendly_name,
+            'activity_name': 'offline',
+            'activity_sid': self.config['twilio_status_mapping']['offline'],
+            'attributes': json.dumps(
+                {'close_user_id': close_user_id, 'groups': groups}
+            ),
+        }
+        return self.workers[sid]
+
+    def churn(self):
+        """Flip one random user's availability, like a real agent would."""
+        with self.lock:
+            user_id = self.random.choice(list(self.availability))
+            status = self.random.choice(['online', 'offline', 'on_call'])
+            if status == 'on_call' or self.availability[user_id] == 'on_call':
+                self.add_event(
+                    'activity.call',
+                    'acti_' + uuid.uuid4().hex,
+                    'created' if status == 'on_call' else 'completed',
+                    user_id=user_id,
+                )
+            self.availability[user_id] = status
+
+    def add_event(self, object_type, object_id, action, user_id=None, **data):
+        now = datetime.now(timezone.utc).isoformat()
+        self.events.append(
+            {
+                'id': 'ev_' + uuid.uuid4().hex,
+                'date_created': now,
+                'date_updated': now,
+                'organization_id': ORGANIZATION_ID,
+                'object_type': object_type,
+                'object_id': object_id,
+                'action': action,
+                'user_id': user_id,
+                'changed_fields': list(data),
+                'data': data,
+            }
+        )
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Base request handler with injected latency and JSON helpers. Subclasses
+    implement `route(method, path, query, body)` and return `(status, dict)`.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        parsed = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        path = [i for i in parsed.path.split('/') if i]
+
+        server = self.server
+        delay = server.latency + server.random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        with server.stats_lock:
+            server.request_count += 1
+
+        try:
+            status, payload = self.route(method, path, query, body)
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        data = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    @property
+    def org(self):
+        return self.server.org
+
+    def route(self, method, path, query, body):
+        raise NotImplementedError
+
+
+class FakeCloseHandler(FakeHandler):
+    """The subset of the Close API (under /api/v1/) that the app uses."""
+
+    def route(self, method, path, query, body):
+        path = path[2:] if path[:2] == ['api', 'v1'] else path
+        org = self.org
+        with org.lock:
+            if path[:1] == ['api_key']:
+                return 200, {'organization_id': ORGANIZATION_ID}
+            if path == ['organization', ORGANIZATION_ID]:
+                return 200, {
+                    'memberships': [
+                        {'user_id': k, 'user_full_name': v}
+                        for k, v in org.users.items()
+                    ]
+                }
+            if path == ['user', 'availability']:
+                return 200, self._availability_page(query)
+            if path[:1] == ['group'] and len(path) == 2:
+                if path[1] not in org.group_members:
+                    return 404, {'error': 'Not found'}
+                return 200, {
+                    'members': [
+                        {'user_id': i} for i in org.group_members[path[1]]
+                    ]
+                }
+            if path == ['event']:
+                return 200, self._events_page(query)
+            if path[:1] == ['phone_number'] and len(path) == 2:
+                if path[1] not in org.participants:
+                    return 404, {'error': 'Not found'}
+                if method == 'PUT':
+                    org.participants[path[1]] = json.loads(body)[
+                        'participants'
+                    ]
+                return 200, {'participants': org.participants[path[1]]}
+        return 404, {'error': 'Not found'}
+
+    def _events_page(self, query):
+        """Events newest first, paged with an offset as the cursor."""
+        events = [
+            i
+            for i in reversed(self.org.events)
+            if i['object_type'] == query.get('object_type', i['object_type'])
+            and i['date_updated'] >= query.get('date_updated__gte', '')
+            and i['date_updated'] > query.get('date_updated__gt', '')
+        ]
+        skip = int(query.get('_cursor', 0))
+        limit = int(query.get('_limit', 50))
+        has_more = skip + limit < len(events)
+        return {
+            'data': events[skip : skip + limit],
+            'cursor_next': str(skip + limit) if has_more else None,
+        }
+
+    def _availability_page(self, query):
+        user_ids = list(self.org.availability)
+        skip = int(query.get('_skip', 0))
+        limit = int(query.get('_limit', len(user_ids) or 1))
+        data = []
+        for user_id in user_ids[skip : skip + limit]:
+            status = self.org.availability[user_id]
+            data.append(
+                {
+                    'user_id': user_id,
+                    'availability': [
+                        {
+                            'type': 'native',
+                            'status': 'online'
+                            if status == 'on_call'
+                            else status,
+                            'active_calls': ['acti_fake']
+                            if status == 'on_call'
+                            else [],
+                        }
+                    ],
+                }
+            )
+        return {'data': data, 'has_more': skip + limit < len(user_ids)}
+
+
+class FakeTaskRouterHandler(FakeHandler):
+    """The subset of the TaskRouter API (under /v1/) that the app uses."""
+
+    def route(self, method, path, query, body):
+        form = {k: v[-1] for k, v in parse_qs(body.decode()).items()}
+        if path[:3] != ['v1', 'Workspaces', WORKSPACE_SID]:
+            return 404, {'message': 'Not found'}
+        path = path[3:]
+        org = self.org
+        with org.lock:
+            if path == ['Workers'] and method == 'GET':
+                return 200, self._workers_page(query)
+            if path == ['Workers'] and method == 'POST':
+                attributes = json.loads(form.get('Attributes', '{}'))
+                worker = org._add_worker(
+                    attributes.get('close_user_id'),
+                    form.get('FriendlyName'),
+                    attributes.get('groups', []),
+                )
+                return 201, self._worker_payload(worker)
+            if path[:1] == ['Workers'] and len(path) == 2:
+                worker = org.workers.get(path[1])
+                if not worker:
+                    return 404, {'message': 'Not found'}
+                if method == 'DELETE':
+                    del org.workers[path[1]]
+                    return 204, None
+                if 'ActivitySid' in form:
+                    worker['activity_sid'] = form['ActivitySid']
+                    worker['activity_name'] = org.activity_sid_to_name.get(
+                        form['ActivitySid'], 'offline'
+                    )
+                if 'Attributes' in form:
+                    worker['attributes'] = form['Attributes']
+                return 200, self._worker_payload(worker)
+            if path[:1] == ['Tasks'] and len(path) == 2 and method == 'POST':
+                org.completed_tasks.add(path[1])
+                return 200, {
+                    'sid': path[1],
+                    'workspace_sid': WORKSPACE_SID,
+                    'assignment_status': form.get('AssignmentStatus'),
+                }
+        return 404, {'message': 'Not found'}
+
+    def _worker_payload(self, worker):
+        return dict(
+            worker, account_sid=ACCOUNT_SID, workspace_sid=WORKSPACE_SID
+        )
+
+    def _workers_page(self, query):
+        page_size = int(query.get('PageSize', 50))
+        page = int(query.get('Page', 0))
+        workers = list(self.org.workers.values())
+        records = workers[page * page_size : (page + 1) * page_size]
+        base = f"http://{self.headers['Host']}/v1/Workspaces/{WORKSPACE_SID}/Workers"
+
+        def page_url(number):
+            return (
+                f"{base}?{urlencode({'PageSize': page_size, 'Page': number})}"
+            )
+
+        has_next = (page + 1) * page_size < len(workers)
+        return {
+            'workers': [self._worker_payload(i) for i in records],
+            'meta': {
+                'key': 'workers',
+                'page': page,
+                'page_size': page_size,
+                'url': page_url(page),
+                'first_page_url': page_url(0),
+                'previous_page_url': page_url(page - 1) if page else None,
+                'next_page_url': page_url(page + 1) if has_next else None,
+            },
+        }
+
+
+class FakeServer(ThreadingHTTPServer):
+    """A threaded fake API server sleeping `latency + U(0, jitter)` seconds
+    before every response."""
+
+    daemon_threads = True
+
+    def __init__(self, handler, org, latency=0.0, jitter=0.0, seed=None):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.org = org
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+import pytest
+
+# Importing anything under app/ boots the app, which needs credentials and
+# tries to reach Close and TaskRouter. Point it at a closed local port so the
+# tests never leave the machine.
+os.environ.setdefault('CLOSE_API_KEY', 'api_test')
+os.environ.setdefault('CLOSE_API_BASE_URL', 'http://127.0.0.1:9/api/v1/')
+os.environ.setdefault('TWILIO_ACCOUNT_SID', 'ACtest')
+os.environ.setdefault('TWILIO_AUTH_TOKEN', 'test')
+os.environ.setdefault('TWILIO_TASKROUTER_BASE_URL', 'http://127.0.0.1:9')
+os.environ.setdefault('BASE_URL', 'http://127.0.0.1/')
+os.environ.setdefault('SHARD_STATE_DIR', tempfile.mkdtemp(prefix='tests-'))
+
+
+class FakeClock:
+    """Stands in for time.monotonic and time.sleep; sleeping moves nothing."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """
+    Returns a function that replaces the monotonic clock and sleep of the
+    given module with a FakeClock, and returns the clock.
+    """
+
+    def patch(module):
+        clock = FakeClock()
+        monkeypatch.setattr(module.time, 'monotonic', clock)
+        monkeypatch.setattr(module.time, 'sleep', clock.sleep)
+        return clock
+
+    return patch
@@ -0,0 +1,211 @@
+import json
+
+from app.change_feed import CALL, GROUP, MEMBERSHIP, ChangeFeed
+
+
+def _date(second):
+    return f'2026-01-01T00:00:{second:02d}.000000+00:00'
+
+
+class StubApi:
+    """A Close API that serves the event log from a list of events."""
+
+    def __init__(self, events=()):
+        self.events = list(events)
+        self.event_queries = []
+        # Called with each event query's params before it is answered.
+        self.before_event_query = None
+
+    def get(self, endpoint, params=None):
+        params = params or {}
+        if endpoint.startswith('group/'):
+            return {'members': []}
+        if endpoint.startswith('organization/'):
+            return {'memberships': []}
+        assert endpoint == 'event'
+        self.event_queries.append(params)
+        if self.before_event_query:
+            self.before_event_query(params)
+        events = [
+            i
+            for i in self.events
+            if params.get('object_type') in (None, i['object_type'])
+            and i['date_updated'] >= params.get('date_updated__gte', '')
+            and i['date_updated'] > params.get('date_updated__gt', '')
+        ]
+        events.sort(key=lambda i: i['date_updated'], reverse=True)
+        return {'data': events[: params.get('_limit', 100)]}
+
+
+def _event(event_id, object_type, second, action='updated', **data):
+    return {
+        'id': event_id,
+        'object_type': object_type,
+        'object_id': data.pop('object_id', None),
+        'action': action,
+        'date_updated': _date(second),
+        'data': data,
+    }
+
+
+def _started_feed(api, tmp_path):
+    api.events.append(_event('ev_start', MEMBERSHIP, 0, action='updated'))
+    feed = ChangeFeed(api, 'orga_1', ['g1'], str(tmp_path / 'feed.json'))
+    feed.start()
+    return feed
+
+
+def test_group_event_written_during_a_poll_is_not_lost(tmp_path):
+    api = StubApi()
+    feed = _started_feed(api, tmp_path)
+
+    def write_events(params):
+        # The group query has already run when these are written.
+        if params.get('object_type') == MEMBERSHIP and not api.events[1:]:
+            api.events.append(
+                _event('ev_g', GROUP, 5, object_id='g1', members=['user_1'])
+            )
+            api.events.append(
+                _event(
+                    'ev_m',
+                    MEMBERSHIP,
+                    6,
+                    action='created',
+                    user_id='user_2',
+                    user_full_name='Two',
+                )
+            )
+
+    api.before_event_query = write_events
+    changes = feed.poll(force=True)
+    assert changes.members_added == {'user_2': 'Two'}
+    assert feed.group_users['g1'] == frozenset()
+
+    changes = feed.poll(force=True)
+    assert changes.groups_changed == {'g1'}
+    assert feed.group_users['g1'] == frozenset({'user_1'})
+
+
+def test_late_event_older_than_the_cursor_is_applied_once(tmp_path):
+    api = StubApi()
+    feed = _started_feed(api, tmp_path)
+    api.events.append(
+        _event('ev_new', GROUP, 10, object_id='g1', members=['user_1'])
+    )
+    feed.poll(force=True)
+    assert feed.cursors[GROUP] == _date(10)
+
+    # Shows up in the log after the newer event was read.
+    api.events.append(
+        _event('ev_late', GROUP, 8, object_id='g1', members=['user_2'])
+    )
+    changes = feed.poll(force=True)
+    assert not changes
+    assert feed.group_users['g1'] == frozenset({'user_1'})
+    assert feed.cursors[GROUP] == _date(10)
+
+    changes = feed.poll(force=True)
+    assert not changes
+
+
+def test_late_event_for_another_group_is_applied(tmp_path):
+    api = StubApi()
+    api.events.append(_event('ev_start', MEMBERSHIP, 0))
+    feed = ChangeFeed(api, 'orga_1', ['g1', 'g2'], str(tmp_path / 'f.json'))
+    feed.start()
+    api.events.append(
+        _event('ev_new', GROUP, 10, object_id='g1', members=['user_1'])
+    )
+    feed.poll(force=True)
+
+    api.events.append(
+        _event('ev_late', GROUP, 8, object_id='g2', members=['user_2'])
+    )
+    changes = feed.poll(force=True)
+    assert changes.groups_changed == {'g2'}
+    assert feed.group_users['g2'] == frozenset({'user_2'})
+
+
+def test_late_membership_event_does_not_undo_a_newer_one(tmp_path):
+    api = StubApi()
+    feed = _started_feed(api, tmp_path)
+    api.events.append(
+        _event('ev_off', MEMBERSHIP, 12, action='deactivated', user_id='u1')
+    )
+    changes = feed.poll(force=True)
+    assert changes.members_removed == {'u1'}
+
+    api.events.append(
+        _event(
+            'ev_on',
+            MEMBERSHIP,
+            11,
+            action='created',
+            user_id='u1',
+            user_full_name='One',
+        )
+    )
+    changes = feed.poll(force=True)
+    assert not changes
+    assert 'u1' not in feed.memberships
+
+
+def test_events_before_the_snapshot_are_not_applied_again(tmp_path):
+    # The group has since been emptied, which the snapshot already shows.
+    api = StubApi(
+        [
+            _event('ev_old', GROUP, 5, object_id='g1', members=['user_1']),
+            _event('ev_start', MEMBERSHIP, 20),
+        ]
+    )
+    feed = ChangeFeed(api, 'orga_1', ['g1'], str(tmp_path / 'feed.json'))
+    feed.start()
+    assert not feed.poll(force=True)
+    assert feed.group_users['g1'] == frozenset()
+
+
+def test_call_events_are_only_checked_for(tmp_path):
+    api = StubApi()
+    feed = _started_feed(api, tmp_path)
+    api.events.extend(_event(f'ev_c{i}', CALL, i) for i in range(1, 40))
+
+    api.event_queries.clear()
+    changes = feed.poll(force=True)
+    assert changes.calls
+    assert feed.cursors[CALL] == _date(39)
+    call_queries = [i for i in api.event_queries if i['object_type'] == CALL]
+    assert [i['_limit'] for i in call_queries] == [1]
+
+    assert not feed.poll(force=True).calls
+
+
+def test_resumes_from_the_saved_cursors(tmp_path):
+    api = StubApi()
+    feed = _started_feed(api, tmp_path)
+    api.events.append(
+        _event('ev_g', GROUP, 5, object_id='g1', members=['user_1'])
+    )
+    feed.poll(force=True)
+
+    resumed = ChangeFeed(api, 'orga_1', ['g1'], str(tmp_path / 'feed.json'))
+    resumed.start()
+    assert resumed.cursors == feed.cursors
+    assert resumed.group_users == {'g1': frozenset({'user_1'})}
+    assert not resumed.poll(force=True)
+
+
+def test_state_saved_by_an_older_version_is_ignored(tmp_path):
+    path = tmp_path / 'feed.json'
+    path.write_text(
+        json.dumps(
+            {
+                'org_id': 'orga_1',
+                'cursor': _date(0),
+                'cursor_event_ids': [],
+                'group_users': {'g1': []},
+                'memberships': {},
+            }
+        )
+    )
+    feed = ChangeFeed(StubApi(), 'orga_1', ['g1'], str(path))
+    assert not feed._load()
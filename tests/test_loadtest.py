@@ -0,0 +1,25 @@
+from loadtest.__main__ import percentile
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 11))
+    assert percentile(values, 50) == 5
+    assert percentile(values, 90) == 9
+    assert percentile(values, 99) == 10
+    assert percentile(values, 100) == 10
+    assert percentile(values, 0) == 1
+
+
+def test_p99_of_a_hundred_calls_is_not_the_max():
+    values = list(range(1, 101))
+    assert percentile(values, 99) == 99
+    assert percentile(values, 50) == 50
+
+
+def test_percentile_of_nothing():
+    assert percentile([], 50) is None
+
+
+def test_percentile_rank_is_not_pushed_up_by_rounding_error():
+    # 0.07 * 100 is 7.000000000000001 in floating point.
+    assert percentile(list(range(1, 101)), 7) == 7
@@ -0,0 +1,106 @@
+import pytest
+
+from app import methods
+from app.state import Activity, WorkerState
+from app.tenants import get_tenant
+
+
+class PagedApi:
+    """A Close API that serves a list endpoint from a list of records."""
+
+    def __init__(self, records, has_more_on_last_page=False):
+        self.records = records
+        self.has_more_on_last_page = has_more_on_last_page
+        self.queries = []
+
+    def get(self, endpoint, params=None):
+        self.queries.append((endpoint, params))
+        skip, limit = params['_skip'], params['_limit']
+        data = self.records[skip : skip + limit]
+        has_more = skip + limit < len(self.records)
+        return {
+            'data': data,
+            'has_more': has_more or self.has_more_on_last_page,
+        }
+
+
+@pytest.fixture
+def tenant(monkeypatch):
+    tenant = get_tenant()
+    monkeypatch.setattr(methods, 'close_page_size', 2)
+    with tenant.activated():
+        yield tenant
+
+
+def test_close_pages_are_read_until_has_more_is_false(tenant, monkeypatch):
+    api = PagedApi([{'id': i} for i in range(5)])
+    monkeypatch.setattr(tenant, 'api', api)
+    records = list(
+        methods._iter_close_pages('user/availability', {'_fields': 'id'})
+    )
+    assert records == [{'id': i} for i in range(5)]
+    assert [i[1]['_skip'] for i in api.queries] == [0, 2, 4]
+    assert all(i[1]['_fields'] == 'id' for i in api.queries)
+    assert all(i[1]['_limit'] == 2 for i in api.queries)
+
+
+def test_close_pages_stop_on_an_empty_page(tenant, monkeypatch):
+    # A misbehaving endpoint that always says there is more.
+    api = PagedApi([{'id': i} for i in range(4)], has_more_on_last_page=True)
+    monkeypatch.setattr(tenant, 'api', api)
+    assert len(list(methods._iter_close_pages('user/availability'))) == 4
+    assert [i[1]['_skip'] for i in api.queries] == [0, 2, 4]
+
+
+def test_close_pages_are_read_lazily(tenant, monkeypatch):
+    api = PagedApi([{'id': i} for i in range(5)])
+    monkeypatch.setattr(tenant, 'api', api)
+    pages = methods._iter_close_pages('user/availability')
+    assert next(pages) == {'id': 0}
+    assert len(api.queries) == 1
+
+
+@pytest.fixture
+def group_updates(monkeypatch):
+    updates = []
+    monkeypatch.setattr(
+        methods,
+        'update_twilio_worker_groups_attribute',
+        lambda sid, user_id, groups: updates.append((sid, groups)),
+    )
+    return updates
+
+
+def _worker(close_user_id='user_1', groups=None):
+    return WorkerState('WK1', 'One', Activity.ONLINE, close_user_id, groups)
+
+
+def test_worker_groups_are_left_alone_when_they_match(group_updates):
+    groups = frozenset({'g1'})
+    methods._update_twilio_worker_groups_from_close_groups(
+        _worker(groups=groups), {'user_1': groups}
+    )
+    # No groups is a match for a user in none of the groups.
+    methods._update_twilio_worker_groups_from_close_groups(
+        _worker(groups=frozenset()), {}
+    )
+    assert group_updates == []
+
+
+def test_missing_worker_groups_are_written(group_updates):
+    methods._update_twilio_worker_groups_from_close_groups(_worker(), {})
+    assert group_updates == [('WK1', frozenset())]
+
+
+def test_changed_worker_groups_are_written(group_updates):
+    methods._update_twilio_worker_groups_from_close_groups(
+        _worker(groups=frozenset({'g1'})), {'user_1': frozenset({'g2'})}
+    )
+    assert group_updates == [('WK1', frozenset({'g2'}))]
+
+
+def test_unmanaged_workers_are_left_alone(group_updates):
+    methods._update_twilio_worker_groups_from_close_groups(
+        _worker(close_user_id=None), {'user_1': frozenset({'g1'})}
+    )
+    assert group_updates == []
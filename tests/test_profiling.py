@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from app import profiling, routes
+
+
+def test_profiles_written_in_the_same_millisecond_get_their_own_files(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setattr(profiling.time, 'time', lambda: 1000.0)
+    first = profiling._Session('sync', profiling.COLLAPSED, 0)
+    second = profiling._Session('sync', profiling.COLLAPSED, 0)
+    assert first.write(str(tmp_path)) != second.write(str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_settings_are_shared_through_the_state_file(tmp_path):
+    changed = profiling.ProfilingSettings()
+    changed.path = str(tmp_path / 'profiling.json')
+    changed.update(sample_rate=0.5, mode=profiling.PSTATS)
+
+    other = profiling.ProfilingSettings()
+    other.path = changed.path
+    other.refresh()
+    assert other.sample_rate == 0.5
+    assert other.mode == profiling.PSTATS
+
+
+def test_directory_cant_be_changed_at_runtime():
+    with pytest.raises(TypeError):
+        profiling.ProfilingSettings().update(directory='/etc')
+
+
+@pytest.mark.parametrize(
+    'authorization', [None, 'Bearer wrong', 'Bearer s\u00e9cret']
+)
+def test_profiling_settings_are_hidden_without_the_admin_token(
+    monkeypatch, authorization
+):
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    headers = {'Authorization': authorization} if authorization else {}
+    response = routes.app.test_client().get(
+        '/admin/profiling/', headers=headers
+    )
+    assert response.status_code == 404
+
+
+def test_profiling_settings_with_the_admin_token(monkeypatch):
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    response = routes.app.test_client().get(
+        '/admin/profiling/', headers={'Authorization': 'Bearer secret'}
+    )
+    assert response.status_code == 200
+    assert 'sample_rate' in response.get_json()
@@ -0,0 +1,244 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import closeio_api
+import pytest
+from closeio_api import APIError
+
+from app import resilience
+from app.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    CloseClient,
+    Deadline,
+    DeadlineExceeded,
+    RateLimiter,
+    run_with_deadline,
+)
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(resilience)
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_circuit_opens_after_failure_threshold(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    breaker.record_success(breaker.before_call())
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.record_success(breaker.before_call())
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    _open(breaker)
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.now += 1
+    started_at = breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success(started_at)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_failed_trial_opens_circuit_again(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_trial_that_never_reports_is_replaced(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    breaker.before_call()
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_stale_success_does_not_close_circuit(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    # A slow call starts while the upstream still looks healthy...
+    slow_started_at = breaker.before_call()
+    clock.now += 1
+    # ...the circuit opens while it's in flight...
+    _open(breaker)
+    clock.now += 1
+    # ...and then it succeeds.
+    breaker.record_success(slow_started_at)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # Nor does it close the circuit once a trial is under way.
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_success(slow_started_at)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_rate_limiter_lets_a_burst_through_then_spaces_requests(clock):
+    limiter = RateLimiter(2, burst=3)
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.slept == []
+
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.slept == [0.5, 1.0]
+
+
+def test_rate_limiter_refills_over_time(clock):
+    limiter = RateLimiter(2, burst=2)
+    limiter.acquire()
+    limiter.acquire()
+    clock.now += 1
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.slept == []
+    # Idle time never fills the bucket past its burst.
+    clock.now += 10
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.slept == [0.5]
+
+
+def test_deadline_counts_down(clock):
+    deadline = Deadline(2)
+    assert deadline.remaining() == 2
+    assert not deadline.expired
+    clock.now += 1.5
+    assert deadline.remaining() == 0.5
+    clock.now += 1
+    assert deadline.remaining() == 0
+    assert deadline.expired
+
+
+def test_run_with_deadline_returns_result():
+    assert run_with_deadline(Deadline(5), lambda: 'done') == 'done'
+
+
+def test_run_with_deadline_gives_up_on_slow_work():
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+
+    try:
+        with pytest.raises(DeadlineExceeded):
+            run_with_deadline(Deadline(0.05), slow)
+    finally:
+        release.set()
+
+
+def test_run_with_deadline_fails_fast_when_expired(clock):
+    deadline = Deadline(1)
+    clock.now += 1
+    with pytest.raises(DeadlineExceeded):
+        run_with_deadline(deadline, lambda: 'done')
+
+
+class StubResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.body
+
+
+def test_close_client_counts_every_bad_gateway(monkeypatch):
+    def no_sleep(seconds):
+        raise AssertionError(f'Slept for {seconds}s')
+
+    monkeypatch.setattr(closeio_api.time, 'sleep', no_sleep)
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+    api = CloseClient('api_test', breaker)
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request)
+        return StubResponse(502)
+
+    monkeypatch.setattr(api.session, 'send', send)
+    for _ in range(3):
+        with pytest.raises(APIError):
+            api.get('me')
+    assert len(sent) == 3
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        api.get('me')
+    assert len(sent) == 3
+
+
+def test_close_client_returns_the_response_body(monkeypatch):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    api = CloseClient('api_test', breaker)
+    monkeypatch.setattr(
+        api.session, 'send', lambda request, **kwargs: StubResponse(200, {})
+    )
+    assert api.get('me') == {}
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_run_with_deadline_can_drop_queued_work():
+    executor = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    ran = []
+    executor.submit(release.wait, 5)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            run_with_deadline(
+                Deadline(0.05),
+                ran.append,
+                'queued',
+                executor=executor,
+                cancel=True,
+            )
+    finally:
+        release.set()
+        executor.shutdown()
+    assert ran == []
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from app import shards
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, 'state_dir', str(tmp_path))
+    return tmp_path
+
+
+def test_one_shard_owns_every_tenant(monkeypatch):
+    monkeypatch.setattr(shards, 'shard_count', 1)
+    monkeypatch.setattr(shards, 'shard_index', 0)
+    assert all(shards.owns(f'tenant-{i}') for i in range(20))
+
+
+def test_each_tenant_has_exactly_one_owner(monkeypatch):
+    monkeypatch.setattr(shards, 'shard_count', 3)
+    owners = {}
+    for index in range(3):
+        monkeypatch.setattr(shards, 'shard_index', index)
+        for i in range(30):
+            if shards.owns(f'tenant-{i}'):
+                assert f'tenant-{i}' not in owners
+                owners[f'tenant-{i}'] = index
+    assert len(owners) == 30
+    # crc32 spreads these tenants across every shard.
+    assert set(owners.values()) == {0, 1, 2}
+
+
+def test_requests_are_coalesced(state_dir):
+    shards.request('brand-a')
+    shards.request('brand-a', shards.INVALIDATE_CLOSE_AVAILABILITY)
+    shards.request('brand-a')
+    assert shards._take_requests('brand-a') == {
+        shards.SYNC,
+        shards.INVALIDATE_CLOSE_AVAILABILITY,
+    }
+    assert shards._take_requests('brand-a') == set()
+    assert shards._take_requests('brand-b') == set()
+
+
+def test_other_kinds_are_only_taken_with_a_sync(state_dir):
+    # What the owner sees while request() is between writing the extra kind
+    # and the sync.
+    open(
+        shards._request_path('brand-a', shards.CHECK_MEMBERSHIPS), 'a'
+    ).close()
+    assert shards._take_requests('brand-a') == set()
+    assert os.path.exists(
+        shards._request_path('brand-a', shards.CHECK_MEMBERSHIPS)
+    )
+
+    shards.request('brand-a')
+    assert shards._take_requests('brand-a') == {
+        shards.SYNC,
+        shards.CHECK_MEMBERSHIPS,
+    }
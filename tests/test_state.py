@@ -0,0 +1,86 @@
+import json
+from types import SimpleNamespace
+
+from app import state
+from app.state import Activity, ParticipantCache, WorkerState, intern_groups
+
+
+def test_participant_cache_is_read_again_after_verify_after(fake_clock):
+    clock = fake_clock(state)
+    cache = ParticipantCache(verify_after=15)
+    assert cache.get('phon_1') is None
+
+    cache.verified('phon_1', ['user_1'])
+    assert cache.get('phon_1') == frozenset({'user_1'})
+    clock.now += 15
+    assert cache.get('phon_1') is None
+
+
+def test_participant_cache_writes_keep_the_last_read_time(fake_clock):
+    clock = fake_clock(state)
+    cache = ParticipantCache(verify_after=15)
+    cache.verified('phon_1', ['user_1'])
+    clock.now += 10
+    cache.written('phon_1', ['user_1', 'user_2'])
+    assert cache.get('phon_1') == frozenset({'user_1', 'user_2'})
+    # A write doesn't tell us about anyone else's writes, so it doesn't
+    # push back the next read.
+    clock.now += 5
+    assert cache.get('phon_1') is None
+
+
+def test_participant_cache_invalidate():
+    cache = ParticipantCache(verify_after=15)
+    cache.verified('phon_1', ['user_1'])
+    cache.invalidate('phon_1')
+    assert cache.get('phon_1') is None
+
+
+def test_participant_cache_off_at_zero():
+    cache = ParticipantCache(verify_after=0)
+    cache.verified('phon_1', ['user_1'])
+    assert cache.get('phon_1') is None
+
+
+def _twilio_worker(activity_name='online', **attributes):
+    return SimpleNamespace(
+        sid='WK1',
+        friendly_name='One',
+        activity_name=activity_name,
+        attributes=json.dumps(attributes),
+    )
+
+
+def test_worker_state_keeps_empty_groups_apart_from_missing_ones():
+    empty = WorkerState.from_twilio(
+        _twilio_worker(close_user_id='user_1', groups=[])
+    )
+    assert empty.groups == frozenset()
+    missing = WorkerState.from_twilio(_twilio_worker(close_user_id='user_1'))
+    assert missing.groups is None
+
+
+def test_worker_state_of_an_unmanaged_worker():
+    worker = WorkerState.from_twilio(_twilio_worker(groups=['g1']))
+    assert worker.close_user_id is None
+    assert worker.groups is None
+
+
+def test_worker_state_activity():
+    worker = WorkerState.from_twilio(
+        _twilio_worker('on_call', close_user_id='user_1', groups=['g1'])
+    )
+    assert worker.activity is Activity.ON_CALL
+    assert worker.groups == frozenset({'g1'})
+
+
+def test_activity_from_unknown_name():
+    assert Activity.from_name('offline') is Activity.OFFLINE
+    assert Activity.from_name('Break') is Activity.UNKNOWN
+    assert Activity.from_name(None) is Activity.UNKNOWN
+
+
+def test_intern_groups_shares_one_set():
+    first = intern_groups(['g1', 'g2'])
+    assert intern_groups(('g2', 'g1')) is first
+    assert intern_groups({'g1'}) is not first
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+from flask import Flask
+
+from app import routes, tenants
+from app.tenants import DEFAULT_TENANT_ID, Tenant, current_tenant
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    """Serve the given tenant IDs from a fresh Flask app with one route."""
+
+    def configure(*tenant_ids):
+        monkeypatch.setattr(
+            tenants, 'tenants', {i: Tenant(i) for i in tenant_ids}
+        )
+        monkeypatch.setattr(routes, 'app', Flask(__name__))
+
+        @routes.tenant_route('/whoami/')
+        def whoami():
+            tenant = current_tenant()
+            return f'{tenant.id} {tenant.url_path("/wait-url/")}'
+
+        return routes.app.test_client()
+
+    return configure
+
+
+def test_sole_tenant_serves_unprefixed_routes(configure):
+    client = configure('brand-a')
+    assert client.get('/whoami/').data == b'brand-a /wait-url/'
+    assert client.get('/brand-a/whoami/').data == b'brand-a /wait-url/'
+
+
+def test_unknown_tenant_is_not_found(configure):
+    client = configure('brand-a')
+    assert client.get('/brand-b/whoami/').status_code == 404
+
+
+def test_default_tenant_serves_unprefixed_routes(configure):
+    client = configure(DEFAULT_TENANT_ID, 'brand-a')
+    assert client.get('/whoami/').data == b'default /wait-url/'
+    assert client.get('/brand-a/whoami/').data == b'brand-a /brand-a/wait-url/'
+
+
+def test_unprefixed_routes_need_a_default_tenant(configure):
+    client = configure('brand-a', 'brand-b')
+    assert client.get('/whoami/').status_code == 404
+    assert client.get('/brand-b/whoami/').data == b'brand-b /brand-b/wait-url/'
+
+
+def _load(tmp_path, monkeypatch, entries):
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps({'tenants': entries}))
+    monkeypatch.setenv('TENANTS_CONFIG', str(path))
+    return tenants._load_tenants()
+
+
+def test_load_tenants(tmp_path, monkeypatch):
+    loaded = _load(
+        tmp_path,
+        monkeypatch,
+        [
+            {'id': 'brand-a'},
+            {'id': 'brand-b', 'close_requests_per_second_per_process': 5},
+        ],
+    )
+    assert list(loaded) == ['brand-a', 'brand-b']
+    assert loaded['brand-a'].api.rate_limiter is None
+    assert loaded['brand-b'].api.rate_limiter.rate == 5
+
+
+def test_load_tenants_rejects_duplicate_ids(tmp_path, monkeypatch):
+    with pytest.raises(ValueError):
+        _load(tmp_path, monkeypatch, [{'id': 'brand-a'}, {'id': 'brand-a'}])
+
+
+@pytest.mark.parametrize('tenant_id', ['Brand-A', 'brand a', '-brand', ''])
+def test_load_tenants_rejects_invalid_ids(tmp_path, monkeypatch, tenant_id):
+    with pytest.raises(ValueError):
+        _load(tmp_path, monkeypatch, [{'id': tenant_id}])